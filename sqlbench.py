@@ -0,0 +1,212 @@
+"""
+Benchmarks for `sqlbuilder` rendering and local execution.
+
+Run it as a script; results are written as JSON, so two runs can be
+compared::
+
+    python sqlbench.py --output before.json
+    python sqlbench.py --rows 100000 --repeat 5
+
+Each benchmark reports its best time (and all times) over
+``--repeat`` runs.  Data is generated from a fixed random seed, so
+runs on the same machine are comparable.  Benchmarks that need NumPy
+are skipped if it isn't installed.
+"""
+
+import optparse
+import platform
+import random
+import sys
+import timeit
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import sqlbuilder
+from sqlbuilder import table, AND, OR, LIKE, IN, Select, Insert, Param, \
+     Prepared
+import sqlmemory
+
+
+def bench(name, func, repeat, **info):
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+    result = {'name': name, 'best': min(times), 'times': times}
+    result.update(info)
+    return result
+
+
+def deepTree(depth):
+    t = table.t
+    expr = t.a == 0
+    for i in range(depth):
+        if i % 2:
+            expr = AND(expr, t.b > i)
+        else:
+            expr = OR(expr, t.c < i)
+    return expr
+
+
+def wideTree(width):
+    t = table.t
+    return AND(*[OR(t.a == i, t.b != i) for i in range(width)])
+
+
+def manyTables(count):
+    tables = [getattr(table, 't%i' % i) for i in range(count)]
+    return Select([t.name for t in tables],
+                  where=AND(*[tables[i].id == tables[i + 1].parent
+                              for i in range(len(tables) - 1)]))
+
+
+def makeRows(count, seed=0):
+    rnd = random.Random(seed)
+    names = ['ian', 'brian', 'bob', 'tim', 'ana']
+    states = ['IL', 'MN', 'CA', 'NY', 'TX']
+    return [{'id': i, 'name': rnd.choice(names), 'state': rnd.choice(states),
+             'zip': rnd.randint(10000, 99999)} for i in xrange(count)]
+
+
+class _RowExecutor(object):
+    row = None
+    def field(self, tableName, fieldName):
+        return self.row[fieldName]
+
+
+def renderBenchmarks(repeat):
+    results = []
+    deep = deepTree(300)
+    results.append(bench('render.deep', lambda: sqlbuilder.sqlrepr(deep),
+                         repeat, depth=300))
+    results.append(bench('render.deep.rebuilt',
+                         lambda: sqlbuilder.sqlrepr(deepTree(300)), repeat,
+                         depth=300))
+    wide = wideTree(5000)
+    results.append(bench('render.wide', lambda: sqlbuilder.sqlrepr(wide),
+                         repeat, width=5000))
+    results.append(bench('render.wide.params',
+                         lambda: sqlbuilder.sqlreprParams(wide), repeat,
+                         width=5000))
+    results.append(bench('build.wide', lambda: wideTree(5000), repeat,
+                         width=5000))
+    cache = sqlbuilder.SQLRenderCache()
+    cache.sqlrepr(wide)
+    results.append(bench('render.wide.cached', lambda: cache.sqlrepr(wide),
+                         repeat, width=5000))
+    # The same query built again for each call, as an application
+    # would: the cache only wins if keying a new tree beats rendering it
+    results.append(bench('render.wide.rebuilt',
+                         lambda: sqlbuilder.sqlrepr(wideTree(5000)), repeat,
+                         width=5000))
+    results.append(bench('render.wide.cached.rebuilt',
+                         lambda: cache.sqlrepr(wideTree(5000)), repeat,
+                         width=5000))
+
+    rows = makeRows(10000)
+    insert = Insert(table.address, rows,
+                    template=['id', 'name', 'state', 'zip'])
+    results.append(bench('insert.render', lambda: sqlbuilder.sqlrepr(insert),
+                         repeat, rows=10000))
+    results.append(bench('insert.statements',
+                         lambda: list(insert.iterStatements(maxBytes=1 << 16)),
+                         repeat, rows=10000))
+    results.append(bench('insert.batches',
+                         lambda: list(insert.iterBatches()), repeat,
+                         rows=10000))
+
+    select = manyTables(100)
+    results.append(bench('select.manyTables',
+                         lambda: sqlbuilder.sqlrepr(select), repeat,
+                         tables=100))
+    results.append(bench('select.manyTables.rebuilt',
+                         lambda: sqlbuilder.sqlrepr(manyTables(100)), repeat,
+                         tables=100))
+    results.append(bench('select.manyTables.cached.rebuilt',
+                         lambda: cache.sqlrepr(manyTables(100)), repeat,
+                         tables=100))
+    prepared = Prepared(Select([table.users.name],
+                               where=AND(table.users.id == Param('id'),
+                                         table.users.state == 'IL')))
+    results.append(bench('prepared.bind',
+                         lambda: [prepared.bind(id=i) for i in xrange(10000)],
+                         repeat, calls=10000))
+    return results
+
+
+def executeBenchmarks(count, repeat):
+    results = []
+    rows = makeRows(count)
+    a = table.address
+    where = AND(LIKE(a.name, '%ia%'), a.zip > 50000,
+                IN(a.state, ['IL', 'MN']))
+
+    def treeWalk():
+        executor = _RowExecutor()
+        for row in rows:
+            executor.row = row
+            sqlbuilder.execute(where, executor)
+    results.append(bench('execute.treeWalk', treeWalk, repeat, rows=count))
+    predicate = sqlbuilder.compilePredicate(where)
+    results.append(bench('execute.compiled', lambda: filter(predicate, rows),
+                         repeat, rows=count))
+    results.append(bench(
+        'execute.adaptive',
+        lambda: list(sqlbuilder.AdaptivePredicate(where).filter(rows)),
+        repeat, rows=count))
+
+    db = sqlmemory.MemoryDatabase()
+    db.addTable(a, rows, indexes=['state'], sortedIndexes=['zip'])
+    select = Select([a.id, a.name], where=AND(a.state == 'IL', a.zip > 90000),
+                    orderBy=a.zip, limit=50)
+    results.append(bench('memory.indexedSelect', lambda: db.select(select),
+                         repeat, rows=count))
+    grouped = Select([a.state, sqlbuilder.func.COUNT(a.id)], groupBy=a.state)
+    results.append(bench('memory.groupBy', lambda: db.select(grouped),
+                         repeat, rows=count))
+
+    try:
+        import sqlcolumns
+    except ImportError:
+        return results
+    columns = {}
+    for name in 'id', 'name', 'state', 'zip':
+        columns[name] = sqlcolumns.numpy.array([row[name] for row in rows])
+    numeric = AND(a.zip > 50000, IN(a.state, ['IL', 'MN']))
+    results.append(bench(
+        'execute.columns', lambda: sqlcolumns.executeColumns(numeric, columns),
+        repeat, rows=count))
+    return results
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [OPTIONS]')
+    parser.add_option('--rows', type='int', default=1000000,
+                      help='Rows for the execution benchmarks')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='Times to run each benchmark')
+    parser.add_option('--output', metavar='FILE',
+                      help='Write the JSON here instead of stdout')
+    options, args = parser.parse_args(args)
+    results = {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'rows': options.rows,
+        'repeat': options.repeat,
+        'benchmarks': (renderBenchmarks(options.repeat)
+                       + executeBenchmarks(options.rows, options.repeat)),
+        }
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,7 +26,9 @@ formed with it will produce SQL statements.
 
 The ``sqlrepr(obj)`` function gets the SQL representation of these
 objects, as well as the proper SQL representation of basic Python
-types (None==NULL).
+types (None==NULL).  ``sqlreprParams(obj, paramstyle='format')``
+returns ``(sql, params)`` instead, with literals replaced by bind
+parameters in any of the DB-API paramstyles.
 
 There are a number of DB-specific SQL features that this does not
 implement.  There are a bunch of normal ANSI features also not present
@@ -50,14 +52,106 @@ class NoDefault:
 True, False = (1==1), (0==1)
 
 import re, fnmatch
+import copy
+import datetime
+import decimal
 import operator
-from converters import sqlrepr, registerConverter, TRUE, FALSE
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from converters import registerConverter, TRUE, FALSE
+from converters import sqlrepr as _convertSqlrepr
 
 safeSQLRE = re.compile(r'^[a-zA-Z][a-zA-Z0-9_\.]*$')
 def sqlIdentifier(obj):
     return type(obj) is type("") and not not safeSQLRE.search(obj.strip())
 
 
+def sqlrepr(obj, db=None):
+    """
+    Like ``converters.sqlrepr``, except that when ``db`` is a
+    `ParamCollector` literal values are replaced by placeholders and
+    collected as bind parameters (see `sqlreprParams`).
+    """
+    # Expressions are dispatched here, not through converters, so
+    # rendering a tree costs no more stack than it used to
+    try:
+        render = obj.__sqlrepr__
+    except AttributeError:
+        pass
+    else:
+        return render(db)
+    if not isinstance(db, ParamCollector):
+        return _convertSqlrepr(obj, db)
+    if obj is None:
+        return 'NULL'
+    if type(obj) in (type([]), type(())):
+        return "(%s)" % ", ".join([sqlrepr(v, db) for v in obj])
+    return db.add(obj)
+
+class ParamCollector:
+    """
+    Passed in place of ``db`` while rendering, to gather bind
+    parameters in one of the DB-API paramstyles.  ``db`` is the real
+    database name, used for anything that still has to be quoted.
+    """
+
+    paramstyles = ('qmark', 'numeric', 'named', 'format', 'pyformat')
+
+    def __init__(self, db=None, paramstyle='format'):
+        if paramstyle not in self.paramstyles:
+            raise ValueError, "Unknown paramstyle: %r" % paramstyle
+        self.db = db
+        self.paramstyle = paramstyle
+        if paramstyle in ('named', 'pyformat'):
+            self.params = {}
+        else:
+            self.params = []
+        self.count = 0
+
+    def add(self, value, name=None):
+        """
+        Adds a parameter and returns its placeholder.  ``name`` is
+        used by the named paramstyles (by default the parameters are
+        numbered).
+        """
+        index = self.count
+        self.count += 1
+        style = self.paramstyle
+        if style in ('named', 'pyformat'):
+            if name is None:
+                name = 'n%i' % index
+            if name in self.params and not _sameParam(self.params[name], value):
+                raise ValueError, "The parameter name %r is used twice" % name
+            self.params[name] = value
+            if style == 'named':
+                return ':' + name
+            return '%%(%s)s' % name
+        self.params.append(value)
+        if style == 'qmark':
+            return '?'
+        elif style == 'numeric':
+            return ':%i' % (index + 1)
+        return '%s'
+
+# The names the named paramstyles give to literals
+_autoParamName = re.compile(r'^n[0-9]+$')
+
+def _sameParam(a, b):
+    return (isinstance(a, Param) and isinstance(b, Param)
+            and a.name == b.name)
+
+def sqlreprParams(obj, db=None, paramstyle='format'):
+    """
+    Returns ``(sql, params)`` for the expression or statement, with
+    literal values replaced by ``paramstyle`` placeholders.  Queries
+    of the same shape give identical SQL, whatever values they use.
+    ``None`` is still rendered inline as ``NULL``.
+    """
+    collector = ParamCollector(db, paramstyle)
+    return sqlrepr(obj, collector), collector.params
+
 def execute(expr, executor):
     if hasattr(expr, 'execute'):
         return expr.execute(executor)
@@ -68,7 +162,11 @@ def execute(expr, executor):
 ## Expression generation
 ########################################
 
-class SQLExpression:
+class SQLExpression(object):
+    # Expression nodes define __slots__, to keep big trees small;
+    # subclasses that don't still get a __dict__ as usual.
+    __slots__ = ('_sqlKey', '_tablesUsed')
+
     def __add__(self, other):
         return SQLOp("+", self, other)
     def __radd__(self, other):
@@ -120,13 +218,13 @@ class SQLExpression:
             return SQLOp("<>", self, other)
 
     def __and__(self, other):
-        return SQLOp("AND", self, other)
+        return SQLBoolOp("AND", (self, other))
     def __rand__(self, other):
-        return SQLOp("AND", other, self)
+        return SQLBoolOp("AND", (other, self))
     def __or__(self, other):
-        return SQLOp("OR", self, other)
+        return SQLBoolOp("OR", (self, other))
     def __ror__(self, other):
-        return SQLOp("OR", other, self)
+        return SQLBoolOp("OR", (other, self))
     def __invert__(self):
         return SQLPrefix("NOT", self)
 
@@ -154,17 +252,243 @@ class SQLExpression:
         return []
 
     def tablesUsed(self):
-        return self.tablesUsedDict().keys()
+        return list(self.tablesUsedSet())
     def tablesUsedDict(self):
-        tables = {}
-        for table in self.tablesUsedImmediate():
-            tables[table] = 1
-        for component in self.components():
-            tables.update(tablesUsedDict(component))
+        return dict.fromkeys(self.tablesUsedSet(), 1)
+    def tablesUsedSet(self):
+        """
+        A frozenset of the names of tables used.  Like `sqlKey` it's
+        only computed once, and builds on the (also kept) sets of the
+        components.
+        """
+        try:
+            return object.__getattribute__(self, '_tablesUsed')
+        except AttributeError:
+            pass
+        sets = [tablesUsedSet(component) for component in self.components()]
+        tables = frozenset(self.tablesUsedImmediate()).union(*sets)
+        self._tablesUsed = tables
         return tables
     def tablesUsedImmediate(self):
         return []
 
+    def pythonSource(self, compiler):
+        raise ValueError, "I don't know how to compile %r" % self
+
+    def simplify(self):
+        return self
+
+    def __getstate__(self):
+        # Needed to pickle slotted classes with protocols 0 and 1.  The
+        # memos are left out, to be made again after unpickling.
+        state = {}
+        for name in _allSlots(self.__class__):
+            if name not in _memoNames:
+                try:
+                    state[name] = object.__getattribute__(self, name)
+                except AttributeError:
+                    pass
+        try:
+            attrs = object.__getattribute__(self, '__dict__')
+        except AttributeError:
+            attrs = {}
+        for name, value in attrs.items():
+            if name not in _memoNames:
+                state[name] = value
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+    def sqlKey(self):
+        """
+        A key for the structure and values of this expression: a
+        number, built from the keys of its components (see
+        `sqlKey`).  Expressions are treated as immutable once built,
+        so the key is only computed once.
+        """
+        # object.__getattribute__ so Table.__getattr__ isn't involved.
+        # The most common nodes start with _sqlKey = None, which saves
+        # raising AttributeError here for each new node.
+        try:
+            key = object.__getattribute__(self, '_sqlKey')
+        except AttributeError:
+            key = None
+        if key is not None:
+            return key
+        cls = self.__class__
+        try:
+            names, hasDict = _keyLayouts[cls]
+        except KeyError:
+            names, hasDict = _keyLayouts[cls] = _keyLayout(cls)
+        parts = [cls]
+        for name in names:
+            try:
+                parts.append(_keyPart(object.__getattribute__(self, name)))
+            except AttributeError:
+                parts.append(NoDefault)
+        if hasDict:
+            attrs = object.__getattribute__(self, '__dict__')
+            for name in sorted(attrs):
+                if not name.startswith('_'):
+                    parts.append(name)
+                    parts.append(_keyPart(attrs[name]))
+        key = self._sqlKey = _keyId(tuple(parts))
+        return key
+
+# Attributes that only cache something computed from the others
+_memoNames = ('_sqlKey', '_tablesUsed', '_fromTables', '_values', '_ops')
+
+_allSlotNames = {}
+
+def _allSlots(cls):
+    names = _allSlotNames.get(cls)
+    if names is None:
+        names = []
+        for klass in cls.__mro__:
+            for name in klass.__dict__.get('__slots__', ()):
+                if name not in names:
+                    names.append(name)
+        _allSlotNames[cls] = names
+    return names
+
+# class -> (public slot names, has a __dict__), for SQLExpression.sqlKey
+_keyLayouts = {}
+
+def _keyLayout(cls):
+    names = []
+    for klass in cls.__mro__:
+        for name in klass.__dict__.get('__slots__', ()):
+            if not name.startswith('_') and name not in names:
+                names.append(name)
+    names.sort()
+    return names, cls.__dictoffset__ != 0
+
+# Keys are hash-consed: each distinct tuple of (class, component
+# keys...) is given a number, so a node's key is a small int, and
+# making it only hashes a tuple of its components' numbers.  Numbers
+# are never reused; when the table is full it's cleared, and trees
+# built after that get new numbers (so they miss in caches, but never
+# match a different tree).  Numbers are only meaningful within a
+# process.
+_keyIds = {}
+_keyIdsSize = 200000
+_keyCounter = itertools.count(1)
+
+def _keyId(parts):
+    key = _keyIds.get(parts)
+    if key is None:
+        if len(_keyIds) >= _keyIdsSize:
+            _keyIds.clear()
+        key = _keyIds.setdefault(parts, _keyCounter.next())
+    return key
+
+# Literals keyed on their value; these compare equal only when they
+# render the same
+_valueTypes = dict.fromkeys([
+    type(0), type(0L), type(True), type(''), type(u''), type(None)])
+# Literals keyed on their repr, as equal values can render differently
+# (0.0 and -0.0, Decimal('1.0') and Decimal('1.00'), datetimes in
+# different timezones)
+_reprTypes = dict.fromkeys([
+    type(0.0), decimal.Decimal, datetime.datetime, datetime.date,
+    datetime.time, datetime.timedelta])
+
+def _keyPart(obj):
+    t = type(obj)
+    if t in _valueTypes:
+        return (t, obj)
+    if isinstance(obj, SQLExpression):
+        return obj.sqlKey()
+    if t in _reprTypes:
+        return (t, repr(obj))
+    if t is type([]) or t is type(()):
+        return (t, _keyId(tuple([_keyPart(v) for v in obj])))
+    if t is type({}):
+        items = [(_keyPart(k), _keyPart(v)) for k, v in obj.items()]
+        items.sort()
+        return (t, _keyId(tuple(items)))
+    if obj is NoDefault:
+        return obj
+    raise TypeError, "Can't make a key for %r" % (obj,)
+
+def sqlKey(obj):
+    """
+    Structural key for an expression or literal, equal for equal
+    expressions.  The key of an expression is a number, however big
+    the tree (see `_keyId`).  Raises TypeError for values of types it
+    can't key: anything but numbers, strings, None, dates, decimals,
+    and lists, tuples and dicts of those.
+    """
+    if isinstance(obj, SQLExpression):
+        return obj.sqlKey()
+    return _keyPart(obj)
+
+class SQLRenderCache:
+    """
+    A bounded LRU cache of rendered SQL, keyed on the structural key
+    of the expression and the database.  ``hits`` and ``misses`` count
+    lookups, so you can tell if ``size`` is big enough.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def sqlrepr(self, obj, db=None):
+        if isinstance(db, ParamCollector):
+            return sqlrepr(obj, db)
+        try:
+            key = (sqlKey(obj), db)
+            hash(key)
+        except TypeError:
+            self.misses += 1
+            return sqlrepr(obj, db)
+        self._lock.acquire()
+        try:
+            value = self._cache.pop(key, None)
+            if value is not None:
+                self.hits += 1
+                self._cache[key] = value
+                return value
+            self.misses += 1
+        finally:
+            self._lock.release()
+        value = sqlrepr(obj, db)
+        self._lock.acquire()
+        try:
+            self._cache[key] = value
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        finally:
+            self._lock.release()
+        return value
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._cache), 'size': self.size}
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+renderCache = SQLRenderCache()
+
+def cachedSqlrepr(obj, db=None):
+    """
+    ``sqlrepr(obj, db)``, going through the module-level
+    `renderCache`.
+    """
+    return renderCache.sqlrepr(obj, db)
+
 #######################################
 # Converter for SQLExpression instances
 #######################################
@@ -180,6 +504,14 @@ def tablesUsedDict(obj):
     else:
         return {}
 
+_noTables = frozenset()
+
+def tablesUsedSet(obj):
+    if isinstance(obj, SQLExpression):
+        return obj.tablesUsedSet()
+    else:
+        return _noTables
+
 operatorMap = {
     "+": operator.add,
     "/": operator.div,
@@ -191,17 +523,57 @@ operatorMap = {
     "!=": operator.ne,
     ">=": operator.ge,
     ">": operator.gt,
-    "IN": operator.contains,
+    "<>": operator.ne,
+    "IN": lambda a, b: a in b,
     "IS": operator.eq,
+    "IS NOT": operator.ne,
+    }
+
+# Python source for operators, used by compileExpression
+pythonOperators = {
+    "+": "+", "-": "-", "*": "*", "/": "/",
+    "<": "<", "<=": "<=", "=": "==", "!=": "!=", "<>": "!=",
+    ">=": ">=", ">": ">",
+    "AND": "and", "OR": "or", "IN": "in",
+    "IS": "==", "IS NOT": "!=",
     }
 
 class SQLOp(SQLExpression):
+    __slots__ = ('op', 'expr1', 'expr2', '_values')
     def __init__(self, op, expr1, expr2):
         self.op = op.upper()
+        # Lists are copied: the key and values are kept, so the node
+        # mustn't change if the caller's list does
+        if type(expr1) is type([]):
+            expr1 = tuple(expr1)
+        if type(expr2) is type([]):
+            expr2 = tuple(expr2)
         self.expr1 = expr1
         self.expr2 = expr2
+        self._sqlKey = None
     def __sqlrepr__(self, db):
         return "(%s %s %s)" % (sqlrepr(self.expr1, db), self.op, sqlrepr(self.expr2, db))
+    def sqlKey(self):
+        # SQLExpression.sqlKey, unrolled for the most common node
+        if self.__class__ is not SQLOp:
+            return SQLExpression.sqlKey(self)
+        try:
+            key = self._sqlKey
+        except AttributeError:
+            key = None
+        if key is None:
+            expr1 = self.expr1
+            if isinstance(expr1, SQLExpression):
+                expr1 = expr1.sqlKey()
+            else:
+                expr1 = _keyPart(expr1)
+            expr2 = self.expr2
+            if isinstance(expr2, SQLExpression):
+                expr2 = expr2.sqlKey()
+            else:
+                expr2 = _keyPart(expr2)
+            key = self._sqlKey = _keyId((SQLOp, self.op, expr1, expr2))
+        return key
     def components(self):
         return [self.expr1, self.expr2]
     def execute(self, executor):
@@ -212,55 +584,326 @@ class SQLOp(SQLExpression):
             return execute(self.expr1, executor) \
                    or execute(self.expr2, executor)
         elif self.op == "LIKE":
-            if not hasattr(self, '_regex'):
-                # @@: Crude, not entirely accurate
-                dest = self.expr2
-                dest = dest.replace("%%", "\001")
-                dest = dest.replace("*", "\002")
-                dest = dest.replace("%", "*")
-                dest = dest.replace("\001", "%")
-                dest = dest.replace("\002", "[*]")
-                self._regex = re.compile(fnmatch.translate(dest), re.I)
-            return self._regex.search(execute(self.expr1, executor))
+            return likeMatcher(self.expr2)(execute(self.expr1, executor))
+        elif self.op == "IN" and type(self.expr2) in (type([]), type(())):
+            if not hasattr(self, '_values'):
+                self._values = _inValues(self.expr2)
+            return execute(self.expr1, executor) in self._values
         else:
             return operatorMap[self.op.upper()](execute(self.expr1, executor),
                                                 execute(self.expr2, executor))
+    def pythonSource(self, compiler):
+        expr1 = compiler.source(self.expr1)
+        if self.op == "LIKE":
+            return "%s(%s)" % (compiler.constant(likeMatcher(self.expr2)), expr1)
+        if self.op == "IN" and type(self.expr2) in (type([]), type(())):
+            return "(%s in %s)" % (expr1, compiler.constant(_inValues(self.expr2)))
+        if self.op in ("IS", "IS NOT") and self.expr2 is None:
+            return "(%s %s None)" % (expr1, self.op.lower())
+        if self.op not in pythonOperators:
+            raise ValueError, "I don't know how to compile the operator %s" % self.op
+        return "(%s %s %s)" % (expr1, pythonOperators[self.op],
+                               compiler.source(self.expr2))
+    def simplify(self):
+        if self.op in ("AND", "OR"):
+            return SQLBoolOp(self.op, (self.expr1, self.expr2)).simplify()
+        expr1 = simplify(self.expr1)
+        expr2 = simplify(self.expr2)
+        if self.op == "IN" and type(expr2) in (type([]), type(())):
+            if not expr2:
+                return SQLFalseClause
+            if len(expr2) == 1 and expr2[0] is not None:
+                return SQLOp("=", expr1, expr2[0]).simplify()
+            if _isNumber(expr1) and not [v for v in expr2 if not _isNumber(v)]:
+                return _clause(expr1 in expr2)
+        elif (_isNumber(expr1) and _isNumber(expr2) and self.op != "/"
+              and self.op in operatorMap):
+            # Only numbers are folded; string comparison and arithmetic
+            # depends on the database (collation, concatenation, ...)
+            try:
+                value = operatorMap[self.op](expr1, expr2)
+            except ArithmeticError:
+                pass
+            else:
+                if type(value) is type(True):
+                    return _clause(value)
+                return value
+        if expr1 is self.expr1 and expr2 is self.expr2:
+            return self
+        return SQLOp(self.op, expr1, expr2)
+
+def _inValues(values):
+    """A frozenset of the values for IN, if they are all hashable"""
+    try:
+        return frozenset(values)
+    except TypeError:
+        return values
+
+_likeCache = {}
+_likeCacheSize = 500
+
+def likeMatcher(pattern):
+    """
+    Returns a function that tells if a value matches the LIKE pattern
+    (case-insensitively).  Matchers are kept in a process-wide cache,
+    and a literal with ``%`` only at the start and/or end is matched
+    with string methods instead of a regular expression.
+    """
+    try:
+        return _likeCache[pattern]
+    except KeyError:
+        pass
+    matcher = _makeLikeMatcher(pattern)
+    if len(_likeCache) >= _likeCacheSize:
+        _likeCache.clear()
+    _likeCache[pattern] = matcher
+    return matcher
+
+def _makeLikeMatcher(pattern):
+    pieces = [piece.replace("\001", "%").lower()
+              for piece in pattern.replace("%%", "\001").split("%")]
+    # ? and [ are wildcards for fnmatch, so those go to the regex
+    if not [1 for piece in pieces if '?' in piece or '[' in piece]:
+        if len(pieces) == 1:
+            literal = pieces[0]
+            return lambda value: value is not None and value.lower() == literal
+        elif len(pieces) == 2 and not pieces[1]:
+            prefix = pieces[0]
+            return lambda value: (value is not None
+                                  and value.lower().startswith(prefix))
+        elif len(pieces) == 2 and not pieces[0]:
+            suffix = pieces[1]
+            return lambda value: (value is not None
+                                  and value.lower().endswith(suffix))
+        elif len(pieces) == 3 and not pieces[0] and not pieces[2]:
+            middle = pieces[1]
+            return lambda value: value is not None and middle in value.lower()
+    regex = _likeRegex(pattern)
+    return lambda value: value is not None and regex.match(value) is not None
+
+def _likeRegex(pattern):
+    # @@: Crude, not entirely accurate
+    dest = pattern
+    dest = dest.replace("%%", "\001")
+    dest = dest.replace("*", "\002")
+    dest = dest.replace("%", "*")
+    dest = dest.replace("\001", "%")
+    dest = dest.replace("\002", "[*]")
+    return re.compile(fnmatch.translate(dest), re.I)
 
 registerConverter(SQLOp, SQLExprConverter)
 
+# Guards the growing of operand lists that SQLBoolOps share
+_opListLock = threading.Lock()
+
+class SQLBoolOp(SQLExpression):
+    """
+    ``AND`` or ``OR`` over any number of operands.  Nested operations
+    of the same kind are flattened when the node is built, so very
+    wide filters render and execute in a loop instead of recursing.
+
+    A node whose first operand is an operation of the same kind
+    shares that operation's list of operands, appending its own
+    (unless something else already has), so building a filter up
+    with ``where = AND(where, cond)`` or ``a & b & c ...`` takes
+    linear time.  ``ops`` is a tuple of just this node's operands.
+    """
+    __slots__ = ('op', '_opList', '_opCount', '_ops')
+    def __init__(self, op, ops):
+        self.op = op.upper()
+        pending = list(ops)
+        pending.reverse()
+        first = None
+        if pending:
+            first = pending[-1]
+            if isinstance(first, SQLBoolOp) and first.op == self.op:
+                pending.pop()
+            else:
+                first = None
+        flat = []
+        while pending:
+            item = pending.pop()
+            if isinstance(item, SQLBoolOp) and item.op == self.op:
+                flat.extend(item.ops)
+            elif isinstance(item, SQLOp) and item.op == self.op:
+                pending.append(item.expr2)
+                pending.append(item.expr1)
+            else:
+                flat.append(item)
+        if first is not None:
+            _opListLock.acquire()
+            try:
+                if len(first._opList) == first._opCount:
+                    first._opList.extend(flat)
+                    flat = first._opList
+                else:
+                    flat = first._opList[:first._opCount] + flat
+            finally:
+                _opListLock.release()
+        self._opList = flat
+        self._opCount = len(flat)
+        self._sqlKey = None
+    def _get_ops(self):
+        try:
+            return self._ops
+        except AttributeError:
+            ops = self._ops = tuple(self._opList[:self._opCount])
+            return ops
+    ops = property(_get_ops)
+    def __getstate__(self):
+        state = SQLExpression.__getstate__(self)
+        state['_opList'] = list(self.ops)
+        return state
+    def __sqlrepr__(self, db):
+        joiner = " %s " % self.op
+        return "(%s)" % joiner.join([sqlrepr(op, db) for op in self.ops])
+    def sqlKey(self):
+        if self.__class__ is not SQLBoolOp:
+            return SQLExpression.sqlKey(self)
+        try:
+            key = self._sqlKey
+        except AttributeError:
+            key = None
+        if key is None:
+            parts = [SQLBoolOp, self.op]
+            for op in self.ops:
+                if isinstance(op, SQLExpression):
+                    parts.append(op.sqlKey())
+                else:
+                    parts.append(_keyPart(op))
+            key = self._sqlKey = _keyId(tuple(parts))
+        return key
+    def components(self):
+        return list(self.ops)
+    def execute(self, executor):
+        value = self.op == "AND"
+        if value:
+            for op in self.ops:
+                value = execute(op, executor)
+                if not value:
+                    break
+        else:
+            for op in self.ops:
+                value = execute(op, executor)
+                if value:
+                    break
+        return value
+    def pythonSource(self, compiler):
+        joiner = " %s " % self.op.lower()
+        return "(%s)" % joiner.join([compiler.source(op) for op in self.ops])
+    def simplify(self):
+        if self.op == "AND":
+            neutral, absorbing = SQLTrueClause, SQLFalseClause
+        else:
+            neutral, absorbing = SQLFalseClause, SQLTrueClause
+        ops = []
+        seen = {}
+        for op in self.ops:
+            op = simplify(op)
+            if type(op) is type(True):
+                op = _clause(op)
+            if op is neutral:
+                continue
+            if op is absorbing:
+                return absorbing
+            if isinstance(op, SQLBoolOp) and op.op == self.op:
+                items = op.ops
+            else:
+                items = [op]
+            for item in items:
+                # Calls may be volatile (RANDOM()), so two of them
+                # aren't the same operand
+                if _hasCall(item):
+                    key = None
+                else:
+                    try:
+                        key = sqlKey(item)
+                    except TypeError:
+                        key = None
+                if key is not None:
+                    if key in seen:
+                        continue
+                    seen[key] = True
+                ops.append(item)
+        if not ops:
+            return neutral
+        if len(ops) == 1:
+            return ops[0]
+        if len(ops) == len(self.ops) and not [
+            1 for new, old in zip(ops, self.ops) if new is not old]:
+            return self
+        return SQLBoolOp(self.op, ops)
+
+registerConverter(SQLBoolOp, SQLExprConverter)
+
 class SQLCall(SQLExpression):
+    __slots__ = ('expr', 'args')
     def __init__(self, expr, args):
         self.expr = expr
-        self.args = args
+        self.args = tuple(args)
+        self._sqlKey = None
     def __sqlrepr__(self, db):
         return "%s%s" % (sqlrepr(self.expr, db), sqlrepr(self.args, db))
     def components(self):
         return [self.expr] + list(self.args)
     def execute(self, executor):
         raise ValueError, "I don't yet know how to locally execute functions"
+    def pythonSource(self, compiler):
+        return compiler.call(self)
+    def simplify(self):
+        args = tuple([simplify(arg) for arg in self.args])
+        if not [1 for arg, old in zip(args, self.args) if arg is not old]:
+            return self
+        return SQLCall(self.expr, args)
 
 registerConverter(SQLCall, SQLExprConverter)
 
 class SQLPrefix(SQLExpression):
+    __slots__ = ('prefix', 'expr')
     def __init__(self, prefix, expr):
         self.prefix = prefix
         self.expr = expr
+        self._sqlKey = None
     def __sqlrepr__(self, db):
         return "%s %s" % (self.prefix, sqlrepr(self.expr, db))
     def components(self):
         return [self.expr]
     def execute(self, executor):
         expr = execute(self.expr, executor)
+        prefix = self.prefix.upper()
         if prefix == "+":
             return expr
         elif prefix == "-":
             return -expr
-        elif prefix.upper() == "NOT":
+        elif prefix == "NOT":
             return not expr
+    def pythonSource(self, compiler):
+        prefix = self.prefix.upper()
+        if prefix not in ("+", "-", "NOT"):
+            raise ValueError, "I don't know how to compile the prefix %s" % self.prefix
+        return "(%s %s)" % (prefix.lower(), compiler.source(self.expr))
+    def simplify(self):
+        expr = simplify(self.expr)
+        prefix = self.prefix.upper()
+        if prefix == "NOT":
+            if isinstance(expr, SQLPrefix) and expr.prefix.upper() == "NOT":
+                return expr.expr
+            if expr is SQLTrueClause:
+                return SQLFalseClause
+            if expr is SQLFalseClause:
+                return SQLTrueClause
+        elif prefix == "-" and _isNumber(expr):
+            return -expr
+        elif prefix == "+" and _isNumber(expr):
+            return expr
+        if expr is self.expr:
+            return self
+        return SQLPrefix(self.prefix, expr)
 
 registerConverter(SQLPrefix, SQLExprConverter)
 
 class SQLConstant(SQLExpression):
+    __slots__ = ('const',)
     def __init__(self, const):
         self.const = const
     def __sqlrepr__(self, db):
@@ -271,32 +914,115 @@ class SQLConstant(SQLExpression):
 registerConverter(SQLConstant, SQLExprConverter)
 
 class SQLTrueClauseClass(SQLExpression):
+    __slots__ = ()
+    def __reduce__(self):
+        # Unpickles as the same singleton
+        return 'SQLTrueClause'
     def __sqlrepr__(self, db):
         return "1 = 1"
     def execute(self, executor):
         return 1
+    def pythonSource(self, compiler):
+        return "True"
 
 SQLTrueClause = SQLTrueClauseClass()
 
 registerConverter(SQLTrueClauseClass, SQLExprConverter)
 
+class SQLFalseClauseClass(SQLExpression):
+    __slots__ = ()
+    def __reduce__(self):
+        # Unpickles as the same singleton
+        return 'SQLFalseClause'
+    def __sqlrepr__(self, db):
+        return "1 = 0"
+    def execute(self, executor):
+        return 0
+    def pythonSource(self, compiler):
+        return "False"
+
+SQLFalseClause = SQLFalseClauseClass()
+
+registerConverter(SQLFalseClauseClass, SQLExprConverter)
+
+def _clause(value):
+    if value:
+        return SQLTrueClause
+    return SQLFalseClause
+
+def _isNumber(value):
+    return type(value) in (type(0), type(0L), type(0.0))
+
+def simplify(expr):
+    """
+    Returns an equivalent expression with constants folded and
+    redundancies removed: true/false clauses in ``AND``/``OR``,
+    repeated operands (unless they call a function, which may be
+    volatile, like ``RANDOM()``), ``NOT NOT x``, one-element and
+    empty ``IN`` lists, and operations between two numbers.
+    Statements get their where (and having) clauses simplified.  The
+    expression itself is not changed.
+    """
+    if isinstance(expr, SQLExpression):
+        return expr.simplify()
+    return expr
+
+def _hasCall(expr):
+    """Tells if there is an `SQLCall` anywhere in the expression"""
+    pending = [expr]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, SQLCall):
+            return True
+        if isinstance(item, SQLExpression):
+            pending.extend(item.components())
+        elif type(item) in (type([]), type(())):
+            pending.extend(item)
+    return False
+
+def _replaced(obj, **attrs):
+    # copy.copy goes through __getstate__, so the memos are left out
+    new = copy.copy(obj)
+    for name, value in attrs.items():
+        setattr(new, name, value)
+    return new
+
 ########################################
 ## Namespaces
 ########################################
 
+# Tables (and their fields) are interned, since expressions are
+# immutable and the same few get used over and over.  It's only a
+# cache, cleared if it gets to _tablesSize tables, so that generated
+# table names don't make it grow forever.
+_tables = {}
+_tablesSize = 10000
+
 class TableSpace:
     def __getattr__(self, attr):
         if attr.startswith('__'):
             raise AttributeError
-        return Table(attr)
+        try:
+            return _tables[attr]
+        except KeyError:
+            if len(_tables) >= _tablesSize:
+                _tables.clear()
+            t = _tables[attr] = Table(attr)
+            return t
 
 class Table(SQLExpression):
+    __slots__ = ('tableName', '_fields')
     def __init__(self, tableName):
         self.tableName = tableName
+        self._fields = {}
     def __getattr__(self, attr):
         if attr.startswith('__'):
             raise AttributeError
-        return Field(self.tableName, attr)
+        try:
+            return self._fields[attr]
+        except KeyError:
+            field = self._fields[attr] = Field(self.tableName, attr)
+            return field
     def __sqlrepr__(self, db):
         return str(self.tableName)
     def execute(self, executor):
@@ -319,15 +1045,19 @@ class SQLObjectTable(Table):
                                   attr)
 
 class Field(SQLExpression):
+    __slots__ = ('tableName', 'fieldName')
     def __init__(self, tableName, fieldName):
         self.tableName = tableName
         self.fieldName = fieldName
+        self._sqlKey = None
     def __sqlrepr__(self, db):
         return self.tableName + "." + self.fieldName
     def tablesUsedImmediate(self):
         return [self.tableName]
     def execute(self, executor):
         return executor.field(self.tableName, self.fieldName)
+    def pythonSource(self, compiler):
+        return compiler.field(self.tableName, self.fieldName)
 
 class SQLObjectField(Field):
     def __init__(self, tableName, fieldName, original):
@@ -352,24 +1082,47 @@ class Select(SQLExpression):
                  having=NoDefault, orderBy=NoDefault, limit=NoDefault):
         if type(items) is not type([]) and type(items) is not type(()):
             items = [items]
-        self.items = items
+        # Copied to tuples, like SQLOp's lists, as fromTables is kept
+        self.items = tuple(items)
         self.whereClause = where
+        if type(groupBy) is type([]):
+            groupBy = tuple(groupBy)
         self.groupBy = groupBy
         self.having = having
+        if type(orderBy) is type([]):
+            orderBy = tuple(orderBy)
         self.orderBy = orderBy
         self.limit = limit
 
+    def simplify(self):
+        where = simplify(self.whereClause)
+        if where is SQLTrueClause:
+            where = NoDefault
+        having = simplify(self.having)
+        if having is SQLTrueClause:
+            having = NoDefault
+        return _replaced(self, whereClause=where, having=having)
+
+    def fromTables(self):
+        """
+        The sorted names of the tables for the FROM clause: those used
+        by the items and the where clause.
+        """
+        try:
+            return self._fromTables
+        except AttributeError:
+            pass
+        things = list(self.items)
+        if self.whereClause is not NoDefault:
+            things.append(self.whereClause)
+        tables = _noTables.union(*[tablesUsedSet(thing) for thing in things])
+        self._fromTables = sorted(tables)
+        return self._fromTables
+
     def __sqlrepr__(self, db):
         select = "SELECT %s" % ", ".join([sqlrepr(v, db) for v in self.items])
 
-        tables = {}
-        things = self.items
-        if self.whereClause is not NoDefault:
-            things.append(self.whereClause)
-        for thing in things:
-            if isinstance(thing, SQLExpression):
-                tables.update(tablesUsedDict(thing))
-        tables = tables.keys()
+        tables = self.fromTables()
         if tables:
             select += " FROM %s" % ", ".join(tables)
 
@@ -400,32 +1153,101 @@ class Insert(SQLExpression):
     def __sqlrepr__(self, db):
         if not self.valueList:
             return ''
-        insert = "INSERT INTO %s" % self.table
-        allowNonDict = True
+        template, allowNonDict = self._template(self.valueList[0])
+        rows = [self._rowSQL(value, template, allowNonDict, db)
+                for value in self.valueList]
+        return self._prefix(template) + ", ".join(rows)
+
+    def iterStatements(self, db=None, maxRows=1000, maxBytes=None,
+                       encoding='utf-8'):
+        """
+        Yields multi-row INSERT statements of at most ``maxRows`` rows
+        and (unless a single row is bigger) ``maxBytes`` bytes, e.g.,
+        to stay under the server's maximum packet size.  Unicode SQL
+        is measured as it will be sent, encoded with ``encoding``.
+        ``valueList`` may be any iterable, and is only consumed as
+        statements are asked for.
+        """
+        rows = iter(self.valueList)
+        for first in rows:
+            break
+        else:
+            return
+        template, allowNonDict = self._template(first)
+        prefix = self._prefix(template)
+        chunk = []
+        size = _byteLength(prefix, encoding)
+        for value in itertools.chain([first], rows):
+            row = self._rowSQL(value, template, allowNonDict, db)
+            rowSize = _byteLength(row, encoding)
+            if chunk and (len(chunk) >= maxRows
+                          or (maxBytes is not None
+                              and size + 2 + rowSize > maxBytes)):
+                yield prefix + ", ".join(chunk)
+                chunk = []
+                size = _byteLength(prefix, encoding)
+            if chunk:
+                size += 2
+            size += rowSize
+            chunk.append(row)
+        if chunk:
+            yield prefix + ", ".join(chunk)
+
+    def iterBatches(self, db=None, batchSize=1000, paramstyle='format'):
+        """
+        Yields ``(sql, paramsList)`` pairs for ``cursor.executemany``,
+        each covering at most ``batchSize`` rows.  Rows only share a
+        batch when they render to the same single-row statement (e.g.,
+        a row using ``const.NOW()`` starts a new batch).
+        """
+        rows = iter(self.valueList)
+        for first in rows:
+            break
+        else:
+            return
+        template, allowNonDict = self._template(first)
+        prefix = self._prefix(template)
+        sql = None
+        batch = []
+        for value in itertools.chain([first], rows):
+            collector = ParamCollector(db, paramstyle)
+            row = self._rowSQL(value, template, allowNonDict, collector)
+            if batch and (row != sql or len(batch) >= batchSize):
+                yield prefix + sql, batch
+                batch = []
+            sql = row
+            batch.append(collector.params)
+        if batch:
+            yield prefix + sql, batch
+
+    def _template(self, first):
         template = self.template
-        if template is NoDefault and type(self.valueList[0]) is type({}):
-            template = self.valueList[0].keys()
-            allowNonDict = False
+        if template is NoDefault and type(first) is type({}):
+            return first.keys(), False
+        return template, True
+
+    def _prefix(self, template):
+        insert = "INSERT INTO %s" % self.table
         if template is not NoDefault:
             insert += " (%s)" % ", ".join(template)
-        first = True
-        insert += " VALUES "
-        for value in self.valueList:
-            if first:
-                first = False
-            else:
-                insert += ", "
-            if type(value) is type({}):
-                if template is NoDefault:
-                    raise TypeError, "You can't mix non-dictionaries with dictionaries in an INSERT if you don't provide a template (%s)" % repr(value)
-                value = dictToList(template, value)
-            elif not allowNonDict:
+        return insert + " VALUES "
+
+    def _rowSQL(self, value, template, allowNonDict, db):
+        if type(value) is type({}):
+            if template is NoDefault:
                 raise TypeError, "You can't mix non-dictionaries with dictionaries in an INSERT if you don't provide a template (%s)" % repr(value)
-            insert += "(%s)" % ", ".join([sqlrepr(v, db) for v in value])
-        return insert
+            value = dictToList(template, value)
+        elif not allowNonDict:
+            raise TypeError, "You can't mix non-dictionaries with dictionaries in an INSERT if you don't provide a template (%s)" % repr(value)
+        return "(%s)" % ", ".join([sqlrepr(v, db) for v in value])
 
 registerConverter(Insert, SQLExprConverter)
 
+def _byteLength(sql, encoding):
+    if type(sql) is type(u''):
+        return len(sql.encode(encoding))
+    return len(sql)
+
 def dictToList(template, dict):
     list = []
     for key in template:
@@ -459,10 +1281,15 @@ class Update(SQLExpression):
                     update += ","
                 update += " %s=%s" % (key, sqlrepr(value, db))
         if self.whereClause is not NoDefault:
-            update += " WHERE %s" % repr(self.whereClause)
+            update += " WHERE %s" % sqlrepr(self.whereClause, db)
         return update
     def sqlName(self):
         return "UPDATE"
+    def simplify(self):
+        where = simplify(self.whereClause)
+        if where is SQLTrueClause:
+            where = NoDefault
+        return _replaced(self, whereClause=where)
 
 registerConverter(Update, SQLExprConverter)
 
@@ -479,6 +1306,8 @@ class Delete(SQLExpression):
             return "DELETE FROM %s" % self.table
         return "DELETE FROM %s WHERE %s" \
                % (self.table, sqlrepr(self.whereClause, db))
+    def simplify(self):
+        return _replaced(self, whereClause=simplify(self.whereClause))
 
 registerConverter(Delete, SQLExprConverter)
 
@@ -488,11 +1317,63 @@ class Replace(Update):
 
 registerConverter(Replace, SQLExprConverter)
 
+def bulkUpdate(table, key, rows, columns=None):
+    """
+    Returns one `Update` that sets the columns of many rows, each
+    found by its ``key`` column::
+
+        UPDATE t SET a=CASE t.id WHEN 1 THEN 'x' WHEN 2 THEN 'y' ELSE t.a END
+          WHERE (t.id IN (1, 2))
+
+    ``rows`` are dictionaries including the key; ``columns`` defaults
+    to the other keys of the first row.  A row without one of the
+    columns leaves it alone; a column no row has is left out.  Use
+    `sqlreprParams` to render it with bind parameters.
+    """
+    rows = list(rows)
+    if not rows:
+        raise ValueError, "You must give at least one row to update"
+    if isinstance(table, Table):
+        table = table.tableName
+    if columns is None:
+        columns = sorted([column for column in rows[0] if column != key])
+    keyField = Field(table, key)
+    values = []
+    template = []
+    for column in columns:
+        cases = [(row[key], row[column]) for row in rows if column in row]
+        # CASE with no WHEN isn't valid SQL, and the column is unchanged
+        if cases:
+            values.append(CASE(keyField, cases, Field(table, column)))
+            template.append(column)
+    if not template:
+        raise ValueError, "None of the rows have any of the columns %s" % (
+            ', '.join(columns))
+    return Update(table, values, template=template,
+                  where=IN(keyField, [row[key] for row in rows]))
+
+def bulkUpdates(table, key, rows, columns=None, chunkSize=1000):
+    """
+    Like `bulkUpdate`, but yields one `Update` for every ``chunkSize``
+    rows, consuming ``rows`` as it goes.
+    """
+    chunk = []
+    for row in rows:
+        if columns is None:
+            columns = sorted([column for column in row if column != key])
+        chunk.append(row)
+        if len(chunk) >= chunkSize:
+            yield bulkUpdate(table, key, chunk, columns)
+            chunk = []
+    if chunk:
+        yield bulkUpdate(table, key, chunk, columns)
+
 ########################################
 ## SQL Builtins
 ########################################
 
 class DESC(SQLExpression):
+    __slots__ = ('expr',)
 
     def __init__(self, expr):
         self.expr = expr
@@ -502,21 +1383,68 @@ class DESC(SQLExpression):
             return sqlrepr(self.expr.expr, db)
         return '%s DESC' % sqlrepr(self.expr, db)
 
+class SQLCase(SQLExpression):
+    __slots__ = ('expr', 'cases', 'default')
+    def __init__(self, expr, cases, default=NoDefault):
+        self.expr = expr
+        self.cases = tuple([tuple(case) for case in cases])
+        self.default = default
+    def __sqlrepr__(self, db):
+        parts = ["CASE"]
+        if self.expr is not NoDefault:
+            parts.append(sqlrepr(self.expr, db))
+        for when, then in self.cases:
+            parts.append("WHEN %s THEN %s" % (sqlrepr(when, db), sqlrepr(then, db)))
+        if self.default is not NoDefault:
+            parts.append("ELSE %s" % sqlrepr(self.default, db))
+        parts.append("END")
+        return " ".join(parts)
+    def components(self):
+        result = []
+        if self.expr is not NoDefault:
+            result.append(self.expr)
+        for when, then in self.cases:
+            result.extend([when, then])
+        if self.default is not NoDefault:
+            result.append(self.default)
+        return result
+    def execute(self, executor):
+        if self.expr is not NoDefault:
+            value = execute(self.expr, executor)
+        for when, then in self.cases:
+            if self.expr is NoDefault:
+                matched = execute(when, executor)
+            else:
+                matched = execute(when, executor) == value
+            if matched:
+                return execute(then, executor)
+        if self.default is not NoDefault:
+            return execute(self.default, executor)
+        return None
+
+registerConverter(SQLCase, SQLExprConverter)
+
+def CASE(expr, cases, default=NoDefault):
+    """
+    ``CASE expr WHEN a THEN b ... ELSE default END``; ``cases`` is a
+    list of ``(when, then)``.  Pass ``NoDefault`` as ``expr`` for the
+    ``CASE WHEN condition THEN ...`` form.
+    """
+    return SQLCase(expr, cases, default)
+
 def AND(*ops):
-    op1 = ops[0]
-    ops = ops[1:]
-    if ops:
-        return SQLOp("AND", op1, AND(*ops))
-    else:
-        return op1
+    if not ops:
+        raise TypeError, "AND() needs at least one operand"
+    if len(ops) == 1:
+        return ops[0]
+    return SQLBoolOp("AND", ops)
 
 def OR(*ops):
-    op1 = ops[0]
-    ops = ops[1:]
-    if ops:
-        return SQLOp("OR", op1, OR(*ops))
-    else:
-        return op1
+    if not ops:
+        raise TypeError, "OR() needs at least one operand"
+    if len(ops) == 1:
+        return ops[0]
+    return SQLBoolOp("OR", ops)
 
 def NOT(op):
     return SQLPrefix("NOT", op)
@@ -545,6 +1473,310 @@ def ISNOTNULL(expr):
 def _likeQuote(s):
     return s.replace('%', '%%')
 
+########################################
+## Prepared statements
+########################################
+
+class Param(SQLExpression):
+    """
+    A named placeholder, for statements rendered once with `Prepared`
+    and given values later.  Outside of `sqlreprParams` it renders as
+    ``:name``.  Names like ``n0``, ``n1`` are reserved for the
+    literals in the named paramstyles.
+    """
+    __slots__ = ('name',)
+    def __init__(self, name):
+        if _autoParamName.match(name):
+            raise ValueError, "Param names like %r are reserved" % name
+        self.name = name
+    def __sqlrepr__(self, db):
+        if isinstance(db, ParamCollector):
+            return db.add(self, self.name)
+        return ':%s' % self.name
+    def execute(self, executor):
+        raise ValueError, "Param %s has no value to execute" % self.name
+
+registerConverter(Param, SQLExprConverter)
+
+class Prepared(object):
+    """
+    A statement rendered once, with `Param` placeholders (and any
+    literals) as bind parameters.  ``bind(**values)`` returns the SQL
+    and parameters without touching the expression again::
+
+        q = Prepared(Select([users.name], where=users.id == Param('id')),
+                     paramstyle='qmark')
+        cursor.execute(*q.bind(id=10))
+    """
+
+    def __init__(self, expr, db=None, paramstyle='format'):
+        self.sql, params = sqlreprParams(expr, db, paramstyle)
+        self.paramstyle = paramstyle
+        if type(params) is type({}):
+            self._fixed = dict([(key, value) for key, value in params.items()
+                                if not isinstance(value, Param)])
+            self._slots = [(key, value.name) for key, value in params.items()
+                           if isinstance(value, Param)]
+        else:
+            self._fixed = [value for value in params]
+            self._slots = [(index, value.name)
+                           for index, value in enumerate(params)
+                           if isinstance(value, Param)]
+        self.names = frozenset([name for slot, name in self._slots])
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.sql)
+
+    def bind(self, **values):
+        """Returns ``(sql, params)`` with the values filled in"""
+        if len(values) != len(self.names) or [
+            1 for name in values if name not in self.names]:
+            raise TypeError, "Expected values for %s, got %s" % (
+                ', '.join(sorted(self.names)), ', '.join(sorted(values)))
+        if type(self._fixed) is type({}):
+            params = self._fixed.copy()
+            for slot, name in self._slots:
+                params[slot] = values[name]
+            return self.sql, params
+        params = list(self._fixed)
+        for slot, name in self._slots:
+            params[slot] = values[name]
+        return self.sql, tuple(params)
+
+########################################
+## Local compilation
+########################################
+
+class ExpressionCompiler:
+    """
+    Turns an expression into the source of a Python expression over
+    ``row``.  ``rowType`` says what rows look like:
+
+    ``'dict'``
+        ``row[fieldName]``
+    ``'tuple'``
+        ``row[i]``, where ``columns[i]`` is ``'fieldName'`` or
+        ``'tableName.fieldName'``
+    ``'attr'``
+        ``row.fieldName``
+    ``'tables'``
+        ``row[tableName][fieldName]``, for rows joined from several
+        tables
+    """
+
+    rowTypes = ('dict', 'tuple', 'attr', 'tables')
+
+    # The expression for the row in the generated source; subclasses
+    # may look for it inside something else
+    rowName = 'row'
+
+    def __init__(self, rowType='dict', columns=None):
+        if rowType not in self.rowTypes:
+            raise ValueError, "Unknown rowType: %r" % rowType
+        if rowType == 'tuple' and columns is None:
+            raise TypeError, "You must give columns for tuple rows"
+        self.rowType = rowType
+        self.columns = columns
+        self.namespace = {}
+
+    def source(self, expr):
+        if isinstance(expr, SQLExpression):
+            return expr.pythonSource(self)
+        return self.constant(expr)
+
+    def constant(self, value):
+        name = '_c%i' % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def field(self, tableName, fieldName):
+        row = self.rowName
+        if self.rowType == 'dict':
+            return '%s[%r]' % (row, fieldName)
+        elif self.rowType == 'attr':
+            return '%s.%s' % (row, fieldName)
+        elif self.rowType == 'tables':
+            return '%s[%r][%r]' % (row, tableName, fieldName)
+        qualified = '%s.%s' % (tableName, fieldName)
+        for name in qualified, fieldName:
+            if name in self.columns:
+                return '%s[%i]' % (row, list(self.columns).index(name))
+        raise KeyError, "No column for %s" % qualified
+
+    def call(self, expr):
+        raise ValueError, "I don't yet know how to locally execute functions"
+
+    def function(self, source):
+        return eval('lambda row: %s' % source, self.namespace)
+
+def compileExpression(expr, rowType='dict', columns=None):
+    """
+    Compiles the expression into a function that takes one row and
+    returns the expression's value for it, without walking the tree
+    or calling an executor per field.  See `ExpressionCompiler` for
+    ``rowType`` and ``columns``.
+    """
+    compiler = ExpressionCompiler(rowType, columns)
+    return compiler.function(compiler.source(expr))
+
+def compilePredicate(expr, rowType='dict', columns=None):
+    """
+    Like `compileExpression`, but the function returns a bool, e.g.,
+    for ``filter(compilePredicate(where), rows)``.
+    """
+    compiler = ExpressionCompiler(rowType, columns)
+    return compiler.function('bool(%s)' % compiler.source(expr))
+
+class AdaptivePredicate(object):
+    """
+    A compiled predicate whose top-level ``AND`` or ``OR`` operands
+    are put in the order that short-circuits most cheaply, based on
+    statistics collected while it runs.
+
+    Use `filter` to filter an iterable: rows are taken in batches of
+    ``batchSize``, and every ``sampleEvery`` full batches (starting
+    with the first) each operand is timed separately over the batch,
+    recording its cost and how many rows pass.  The operands are then
+    sorted by cost / (1 - selectivity) for ``AND``, or cost /
+    selectivity for ``OR``, and the predicate recompiled in that
+    order.  Older samples count for less, so the order follows changes
+    in the data.  Inputs smaller than ``batchSize`` are never sampled.
+
+    Evaluation short-circuits like ``execute()``, so an operand may
+    rely on the ones written before it (``AND(a.y != 0, a.x / a.y >
+    1)``).  If an operand raises while it is sampled, or a reordered
+    predicate raises, the predicate goes back to the written order
+    for good (and the batch is filtered again in that order).
+    """
+
+    decay = 0.5
+
+    def __init__(self, expr, rowType='dict', columns=None,
+                 batchSize=1000, sampleEvery=20):
+        self.expr = expr
+        self.rowType = rowType
+        self.columns = columns
+        self.batchSize = batchSize
+        self.sampleEvery = sampleEvery
+        if isinstance(expr, SQLBoolOp) and len(expr.ops) > 1:
+            self.op = expr.op
+            self.operands = list(expr.ops)
+        else:
+            self.op = None
+            self.operands = [expr]
+        self._tests = [compilePredicate(operand, rowType, columns)
+                       for operand in self.operands]
+        # [seconds, rows, rows passed] for each operand
+        self._stats = [[0.0, 0.0, 0.0] for operand in self.operands]
+        self.order = range(len(self.operands))
+        self._predicate = compilePredicate(expr, rowType, columns)
+        self._batches = 0
+        self._adapting = self.op is not None
+
+    def __call__(self, row):
+        return self._predicate(row)
+
+    def filter(self, rows):
+        """Yields the rows that match"""
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batchSize:
+                for row in self.filterBatch(batch):
+                    yield row
+                batch = []
+        if batch:
+            for row in self.filterBatch(batch):
+                yield row
+
+    def filterBatch(self, batch):
+        """Returns the rows of the list that match"""
+        if self._adapting and len(batch) >= self.batchSize:
+            sample = self._batches % self.sampleEvery == 0
+            self._batches += 1
+            if sample:
+                matched = self._sample(batch)
+                if matched is not None:
+                    return matched
+        try:
+            return filter(self._predicate, batch)
+        except Exception:
+            if self.order == range(len(self.operands)):
+                raise
+            self._keepOrder()
+            return filter(self._predicate, batch)
+
+    def _sample(self, batch):
+        """
+        Filters the batch testing every operand on every row, and
+        reorders; returns None if an operand raised.
+        """
+        results = []
+        samples = []
+        for test in self._tests:
+            start = time.time()
+            try:
+                passed = map(test, batch)
+            except Exception:
+                self._keepOrder()
+                return None
+            samples.append((time.time() - start, passed.count(True)))
+            results.append(passed)
+        for stats, (elapsed, count) in zip(self._stats, samples):
+            stats[0] = stats[0] * self.decay + elapsed
+            stats[1] = stats[1] * self.decay + len(batch)
+            stats[2] = stats[2] * self.decay + count
+        if self.op == "AND":
+            matched = [row for row, flags in zip(batch, zip(*results))
+                       if False not in flags]
+        else:
+            matched = [row for row, flags in zip(batch, zip(*results))
+                       if True in flags]
+        self.reorder()
+        return matched
+
+    def _keepOrder(self):
+        """Goes back to the written order, and stops adapting"""
+        self._adapting = False
+        self.order = range(len(self.operands))
+        self._predicate = compilePredicate(self.expr, self.rowType,
+                                           self.columns)
+
+    def statistics(self):
+        """
+        Returns ``(operand, secondsPerRow, selectivity)`` for each
+        operand, in the current order.
+        """
+        result = []
+        for index in self.order:
+            seconds, rows, passed = self._stats[index]
+            if rows:
+                result.append((self.operands[index], seconds / rows,
+                               passed / rows))
+            else:
+                result.append((self.operands[index], None, None))
+        return result
+
+    def reorder(self):
+        ranks = []
+        for index, (seconds, rows, passed) in enumerate(self._stats):
+            if not rows:
+                return
+            cost = seconds / rows
+            selectivity = passed / rows
+            if self.op == "AND":
+                rank = cost / max(1 - selectivity, 1e-6)
+            else:
+                rank = cost / max(selectivity, 1e-6)
+            ranks.append((rank, index))
+        ranks.sort()
+        order = [pair[1] for pair in ranks]
+        if order != self.order:
+            self.order = order
+            self._predicate = compilePredicate(
+                SQLBoolOp(self.op, [self.operands[i] for i in order]),
+                self.rowType, self.columns)
+
 ########################################
 ## Global initializations
 ########################################
@@ -557,6 +1789,169 @@ func = const
 ## Testing
 ########################################
 
+__test__ = {
+    'params':
+    r"""
+    >>> a = table.a
+    >>> q = Select([a.name], where=AND(a.id == 5, a.name == 'bob', a.x == None))
+    >>> for paramstyle in 'qmark', 'format', 'numeric':
+    ...     print sqlreprParams(q, paramstyle=paramstyle)
+    ('SELECT a.name FROM a WHERE ((a.id = ?) AND (a.name = ?) AND (a.x IS NULL))', [5, 'bob'])
+    ('SELECT a.name FROM a WHERE ((a.id = %s) AND (a.name = %s) AND (a.x IS NULL))', [5, 'bob'])
+    ('SELECT a.name FROM a WHERE ((a.id = :1) AND (a.name = :2) AND (a.x IS NULL))', [5, 'bob'])
+    >>> for paramstyle in 'named', 'pyformat':
+    ...     sql, params = sqlreprParams(q, paramstyle=paramstyle)
+    ...     print sql, sorted(params.items())
+    SELECT a.name FROM a WHERE ((a.id = :n0) AND (a.name = :n1) AND (a.x IS NULL)) [('n0', 5), ('n1', 'bob')]
+    SELECT a.name FROM a WHERE ((a.id = %(n0)s) AND (a.name = %(n1)s) AND (a.x IS NULL)) [('n0', 5), ('n1', 'bob')]
+    >>> sqlreprParams(Select([a.name], where=AND(a.id == 7, a.name == 'tim', a.x == None)))[0] == sqlreprParams(q)[0]
+    True
+    >>> q.fromTables()
+    ['a']
+    >>> deep = reduce(operator.add, [a.x] * 400)
+    >>> len(sqlrepr(deep)), len(sqlreprParams(deep)[0])
+    (3195, 3195)
+    """,
+    'renderCache':
+    r"""
+    >>> def build():
+    ...     return AND(table.a.x == 1, OR(table.a.y > 2, table.a.z == None))
+    >>> sqlKey(build()) == sqlKey(build()), sqlKey(table.a.x == 1) == sqlKey(table.a.x == 2)
+    (True, False)
+    >>> cache = SQLRenderCache(size=10)
+    >>> cache.sqlrepr(build())
+    '((a.x = 1) AND ((a.y > 2) OR (a.z IS NULL)))'
+    >>> cache.sqlrepr(build())
+    '((a.x = 1) AND ((a.y > 2) OR (a.z IS NULL)))'
+    >>> sorted(cache.stats().items())
+    [('entries', 1), ('hits', 1), ('misses', 1), ('size', 10)]
+    >>> ids = [1, 2]
+    >>> q = IN(table.a.x, ids)
+    >>> cache.sqlrepr(q)
+    '(a.x IN (1, 2))'
+    >>> ids.append(3)
+    >>> cache.sqlrepr(q), sqlrepr(q)
+    ('(a.x IN (1, 2))', '(a.x IN (1, 2))')
+    """,
+    'compile':
+    r"""
+    >>> a = table.a
+    >>> pred = compilePredicate(AND(a.x > 1, LIKE(a.name, 'b%'), IN(a.y, [1, 2])))
+    >>> pred({'x': 2, 'name': 'Bob', 'y': 2}), pred({'x': 2, 'name': 'tim', 'y': 2})
+    (True, False)
+    >>> compileExpression(a.x * 2 + a.y, 'tuple', ['x', 'a.y'])((3, 1))
+    7
+    >>> match = likeMatcher('%an%')
+    >>> match('Brian'), match('bob'), match(None)
+    (True, False, False)
+    """,
+    'simplify':
+    r"""
+    >>> a = table.a
+    >>> simplify(AND(a.x == 1, SQLTrueClause, a.x == 1, 2 + 3 > 4))
+    (a.x = 1)
+    >>> simplify(OR(a.x == 1, NOT(NOT(a.y == 2)), IN(a.z, [3])))
+    ((a.x = 1) OR (a.y = 2) OR (a.z = 3))
+    >>> simplify(AND(a.x == 1, IN(a.y, [])))
+    1 = 0
+    >>> simplify(AND(func.RANDOM() > 0.5, func.RANDOM() > 0.5))
+    ((RANDOM() > 0.5) AND (RANDOM() > 0.5))
+    >>> simplify(Select([a.x], where=OR(a.x == 1, SQLTrueClause)))
+    SELECT a.x FROM a
+    """,
+    'pickle':
+    r"""
+    >>> import pickle
+    >>> expr = AND(table.a.x == 1, OR(table.a.y > 2, table.a.z == None))
+    >>> for protocol in 0, 1, 2:
+    ...     print pickle.loads(pickle.dumps(expr, protocol))
+    ((a.x = 1) AND ((a.y > 2) OR (a.z IS NULL)))
+    ((a.x = 1) AND ((a.y > 2) OR (a.z IS NULL)))
+    ((a.x = 1) AND ((a.y > 2) OR (a.z IS NULL)))
+    >>> pickle.loads(pickle.dumps(SQLTrueClause)) is SQLTrueClause
+    True
+    """,
+    'boolop':
+    r"""
+    >>> AND(table.a.x == 1, AND(table.a.y == 2, table.a.z == 3))
+    ((a.x = 1) AND (a.y = 2) AND (a.z = 3))
+    >>> AND(table.a.x == 1)
+    (a.x = 1)
+    >>> both = table.a.x == 1
+    >>> for i in range(2, 4):
+    ...     both = both & (table.a.x == i)
+    >>> AND(both, table.a.y == 1), AND(both, table.a.z == 1), both
+    (((a.x = 1) AND (a.x = 2) AND (a.x = 3) AND (a.y = 1)), ((a.x = 1) AND (a.x = 2) AND (a.x = 3) AND (a.z = 1)), ((a.x = 1) AND (a.x = 2) AND (a.x = 3)))
+    >>> AND()
+    Traceback (most recent call last):
+        ...
+    TypeError: AND() needs at least one operand
+    >>> OR()
+    Traceback (most recent call last):
+        ...
+    TypeError: OR() needs at least one operand
+    """,
+    'insert':
+    r"""
+    >>> insert = Insert(table.a, [(u'\xe9' * 10,), (u'\xe9' * 10,)],
+    ...                 template=['name'])
+    >>> len(list(insert.iterStatements(maxBytes=70)))
+    2
+    >>> len(list(insert.iterStatements(maxBytes=110)))
+    1
+    >>> for sql, params in Insert(table.a, [(1, 2), (3, 4), (5, const.NOW())],
+    ...                           template=['x', 'y']).iterBatches(batchSize=2):
+    ...     print sql, params
+    INSERT INTO a (x, y) VALUES (%s, %s) [[1, 2], [3, 4]]
+    INSERT INTO a (x, y) VALUES (%s, NOW()) [[5]]
+    """,
+    'bulkUpdate':
+    r"""
+    >>> bulkUpdate(table.a, 'id', [{'id': 1, 'v': 'x'}, {'id': 2, 'v': 'y'}])
+    UPDATE a SET v=CASE a.id WHEN 1 THEN 'x' WHEN 2 THEN 'y' ELSE a.v END WHERE (a.id IN (1, 2))
+    >>> bulkUpdate(table.a, 'id', [{'id': 1, 'v': 'x'}], columns=['v', 'w'])
+    UPDATE a SET v=CASE a.id WHEN 1 THEN 'x' ELSE a.v END WHERE (a.id IN (1))
+    >>> bulkUpdate(table.a, 'id', [{'id': 1, 'v': 'x'}], columns=['w'])
+    Traceback (most recent call last):
+        ...
+    ValueError: None of the rows have any of the columns w
+    """,
+    'prepared':
+    r"""
+    >>> a = table.a
+    >>> q = Prepared(Select([a.x], where=AND(a.y == 5, a.x == Param('x'))),
+    ...              paramstyle='named')
+    >>> sql, params = q.bind(x=1)
+    >>> sql, sorted(params.items())
+    ('SELECT a.x FROM a WHERE ((a.y = :n0) AND (a.x = :x))', [('n0', 5), ('x', 1)])
+    >>> q = Prepared(AND(a.x == Param('x'), a.y == Param('x')), paramstyle='qmark')
+    >>> q.bind(x=1)
+    ('((a.x = ?) AND (a.y = ?))', (1, 1))
+    >>> q.bind(y=1)
+    Traceback (most recent call last):
+        ...
+    TypeError: Expected values for x, got y
+    >>> Param('n0')
+    Traceback (most recent call last):
+        ...
+    ValueError: Param names like 'n0' are reserved
+    """,
+    'adaptive':
+    r"""
+    >>> rows = [{'x': i % 7, 'y': i % 3} for i in range(40)]
+    >>> where = AND(table.t.y != 0, table.t.x / table.t.y > 1)
+    >>> pred = AdaptivePredicate(where, batchSize=4, sampleEvery=1)
+    >>> len(list(pred.filter(rows))) == len(filter(compilePredicate(where), rows))
+    True
+    >>> [operand for operand, cost, selectivity in pred.statistics()]
+    [(t.y <> 0), ((t.x / t.y) > 1)]
+    >>> where = OR(table.t.x == 3, table.t.y == 1)
+    >>> list(AdaptivePredicate(where, batchSize=4).filter(rows)) == filter(
+    ...     compilePredicate(where), rows)
+    True
+    """,
+    }
+
 if __name__ == "__main__":
     tests = """
 >>> AND(table.address.name == "Ian Bicking", table.address.zip > 30000)
@@ -574,3 +1969,5 @@ if __name__ == "__main__":
         if not expr.strip(): continue
         if expr.startswith('>>> '):
             expr = expr[4:]
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,147 @@
+"""
+Evaluates `sqlbuilder` expressions over whole columns at once with
+NumPy, instead of one row at a time through ``execute(executor)``.
+
+Columns are given as a mapping from ``'fieldName'`` or
+``'tableName.fieldName'`` to arrays (or anything ``numpy.asarray``
+accepts), all of the same length.  Predicates evaluate to boolean
+masks, and arithmetic to value arrays::
+
+    >>> from sqlbuilder import table, AND, IN
+    >>> cols = {'zip': [100, 200, 300, 400], 'state': ['IL', 'MN', 'IL', 'CA']}
+    >>> executeColumns(AND(table.address.zip > 150,
+    ...                    IN(table.address.state, ['IL', 'CA'])), cols)
+    array([False, False,  True,  True])
+    >>> executeColumns(table.address.zip * 2, cols)
+    array([200, 400, 600, 800])
+    >>> selectColumns(cols, table.address.zip > 250)['state']
+    array(['IL', 'CA'], dtype='|S2')
+
+``None`` in object columns and NaN in float columns count as NULL
+for ``ISNULL`` and ``ISNOTNULL``.
+"""
+
+import numpy
+import sqlbuilder
+
+operatorFunctions = {
+    "+": numpy.add,
+    "-": numpy.subtract,
+    "*": numpy.multiply,
+    "/": numpy.divide,
+    "<": numpy.less,
+    "<=": numpy.less_equal,
+    "=": numpy.equal,
+    "!=": numpy.not_equal,
+    "<>": numpy.not_equal,
+    ">=": numpy.greater_equal,
+    ">": numpy.greater,
+    "AND": numpy.logical_and,
+    "OR": numpy.logical_or,
+    }
+
+
+class ColumnExecutor(object):
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.length = None
+        for value in columns.values():
+            self.length = len(value)
+            break
+        self._arrays = {}
+
+    def column(self, tableName, fieldName):
+        qualified = '%s.%s' % (tableName, fieldName)
+        for name in qualified, fieldName:
+            if name in self._arrays:
+                return self._arrays[name]
+            if name in self.columns:
+                array = numpy.asarray(self.columns[name])
+                self._arrays[name] = array
+                return array
+        raise KeyError("No column for %s" % qualified)
+
+    def execute(self, expr):
+        if isinstance(expr, sqlbuilder.Field):
+            return self.column(expr.tableName, expr.fieldName)
+        elif isinstance(expr, sqlbuilder.SQLBoolOp):
+            func = operatorFunctions[expr.op]
+            result = self.execute(expr.ops[0])
+            for op in expr.ops[1:]:
+                result = func(result, self.execute(op))
+            return result
+        elif isinstance(expr, sqlbuilder.SQLOp):
+            return self.executeOp(expr)
+        elif isinstance(expr, sqlbuilder.SQLPrefix):
+            value = self.execute(expr.expr)
+            prefix = expr.prefix.upper()
+            if prefix == "NOT":
+                return numpy.logical_not(value)
+            elif prefix == "-":
+                return numpy.negative(value)
+            elif prefix == "+":
+                return value
+            raise ValueError(
+                "I don't know how to execute the prefix %s" % expr.prefix)
+        elif isinstance(expr, sqlbuilder.SQLTrueClauseClass):
+            return numpy.ones(self.length, bool)
+        elif isinstance(expr, sqlbuilder.SQLFalseClauseClass):
+            return numpy.zeros(self.length, bool)
+        elif isinstance(expr, sqlbuilder.SQLExpression):
+            raise ValueError("I don't know how to execute %r on columns" % expr)
+        return expr
+
+    def executeOp(self, expr):
+        op = expr.op
+        if op in ("IS", "IS NOT") and expr.expr2 is None:
+            nulls = isNull(self.execute(expr.expr1))
+            if op == "IS NOT":
+                return numpy.logical_not(nulls)
+            return nulls
+        left = self.execute(expr.expr1)
+        if op == "IN":
+            return numpy.in1d(left, list(expr.expr2))
+        elif op == "LIKE":
+            matcher = sqlbuilder.likeMatcher(expr.expr2)
+            left = numpy.asarray(left)
+            return numpy.fromiter(
+                [matcher(value) for value in left.flat],
+                bool, left.size).reshape(left.shape)
+        if op not in operatorFunctions:
+            raise ValueError("I don't know how to execute the operator %s" % op)
+        return operatorFunctions[op](left, self.execute(expr.expr2))
+
+
+def isNull(values):
+    values = numpy.asarray(values)
+    if values.dtype.kind == 'f':
+        return numpy.isnan(values)
+    elif values.dtype.kind == 'O':
+        return numpy.equal(values, None)
+    return numpy.zeros(values.shape, bool)
+
+
+def executeColumns(expr, columns):
+    """
+    Returns the value of ``expr`` over all rows of ``columns``, as an
+    array (or a scalar, if the expression uses no columns).
+    """
+    return ColumnExecutor(columns).execute(expr)
+
+
+def selectColumns(columns, where):
+    """
+    Returns a new column mapping with only the rows matching ``where``.
+    """
+    executor = ColumnExecutor(columns)
+    mask = numpy.asarray(executor.execute(where), bool)
+    result = {}
+    for name in columns:
+        result[name] = numpy.asarray(columns[name])[mask]
+    return result
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,253 @@
+"""
+Runs `sqlbuilder` statements on DB-API connections.
+
+Connections come from a bounded `ConnectionPool`, created as needed
+by the ``connect`` function you give it::
+
+    import sqlite3
+    pool = ConnectionPool(
+        lambda: sqlite3.connect('app.db', check_same_thread=False), size=4)
+    db = DBExecutor(pool, paramstyle=sqlite3.paramstyle)
+
+    db.execute(Insert(table.users, rows))      # executemany, in batches
+    for name, in db.select(Select([table.users.name])):
+        ...                                    # fetchmany, as a generator
+    db.execute(Update(table.users, {'age': 1}, where=table.users.id == 2))
+
+All statements are rendered with bind parameters (see
+``sqlbuilder.sqlreprParams``), and ``Prepared`` statements can be
+given their values as keyword arguments.  With ``threads`` set,
+`DBExecutor.submit` and `DBExecutor.map` run statements concurrently
+on a thread pool, each with its own pooled connection.
+"""
+
+import Queue
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import sqlbuilder
+from sqlbuilder import Select, Insert, Prepared
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Holds at most ``size`` connections, made with ``connect()`` the
+    first time they are needed.  `acquire` blocks (up to ``timeout``
+    seconds, if given) while all of them are in use.
+    """
+
+    def __init__(self, connect, size=5, timeout=None):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        # None stands for a connection that hasn't been made yet
+        self._slots = Queue.LifoQueue()
+        for i in range(size):
+            self._slots.put(None)
+
+    def acquire(self):
+        try:
+            conn = self._slots.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise PoolTimeout(
+                "No connection available after %s seconds" % self.timeout)
+        if conn is None:
+            try:
+                conn = self.connect()
+            except:
+                self._slots.put(None)
+                raise
+        return conn
+
+    def release(self, conn, discard=False):
+        """
+        Returns the connection to the pool; with ``discard`` it is
+        closed, and a new one will be made in its place.
+        """
+        if discard:
+            try:
+                conn.close()
+            finally:
+                self._slots.put(None)
+        else:
+            self._slots.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except:
+            self.release(conn, discard=_isBroken(conn))
+            raise
+        self.release(conn)
+
+    def close(self):
+        """Closes the idle connections"""
+        conns = []
+        while True:
+            try:
+                conns.append(self._slots.get_nowait())
+            except Queue.Empty:
+                break
+        for conn in conns:
+            if conn is not None:
+                conn.close()
+            self._slots.put(None)
+
+
+def _isBroken(conn):
+    try:
+        conn.rollback()
+    except Exception:
+        return True
+    return False
+
+
+class DBExecutor(object):
+
+    def __init__(self, pool, paramstyle='format', db=None, batchSize=1000,
+                 fetchSize=500, threads=None):
+        self.pool = pool
+        self.paramstyle = paramstyle
+        self.db = db
+        self.batchSize = batchSize
+        self.fetchSize = fetchSize
+        self.threads = threads
+        self._threadPool = None
+
+    def render(self, stmt, **values):
+        """Returns ``(sql, params)`` for the statement"""
+        if isinstance(stmt, Prepared):
+            return stmt.bind(**values)
+        return sqlbuilder.sqlreprParams(stmt, self.db, self.paramstyle)
+
+    def execute(self, stmt, **values):
+        """
+        Runs the statement.  A ``Select`` returns a list of rows;
+        anything else is committed, and returns the rowcount (summed
+        over the batches of an ``Insert``).
+        """
+        if isinstance(stmt, Select) or (
+            isinstance(stmt, Prepared) and stmt.sql.startswith('SELECT ')):
+            return list(self.select(stmt, **values))
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                count = 0
+                if isinstance(stmt, Insert):
+                    for sql, paramsList in stmt.iterBatches(
+                        self.db, self.batchSize, self.paramstyle):
+                        cursor.executemany(sql, paramsList)
+                        count += max(cursor.rowcount, 0)
+                else:
+                    cursor.execute(*self.render(stmt, **values))
+                    count = cursor.rowcount
+                conn.commit()
+            finally:
+                cursor.close()
+        return count
+
+    def select(self, select, **values):
+        """
+        Yields the rows of a ``Select``, fetching ``fetchSize`` at a
+        time.  The connection is held until the generator is
+        exhausted or closed.
+        """
+        sql, params = self.render(select, **values)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(self.fetchSize)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
+
+    def submit(self, stmt, **values):
+        """
+        Runs `execute` on the thread pool, returning an ``AsyncResult``
+        (call ``.get()`` for the result).
+        """
+        return self.threadPool().apply_async(self.execute, (stmt,), values)
+
+    def map(self, stmts):
+        """Runs the statements concurrently, returning their results"""
+        return self.threadPool().map(self.execute, stmts)
+
+    def threadPool(self):
+        if self._threadPool is None:
+            if not self.threads:
+                raise ValueError(
+                    "You must give threads to run statements concurrently")
+            self._threadPool = ThreadPool(self.threads)
+        return self._threadPool
+
+    def close(self):
+        if self._threadPool is not None:
+            self._threadPool.close()
+            self._threadPool.join()
+            self._threadPool = None
+        self.pool.close()
+
+__test__ = {
+    'sqldbapi':
+    r"""
+    >>> import sqlite3
+    >>> from sqlbuilder import table, Update, Delete, Param
+    >>> pool = ConnectionPool(
+    ...     lambda: sqlite3.connect(':memory:', check_same_thread=False),
+    ...     size=1, timeout=0.1)
+    >>> db = DBExecutor(pool, paramstyle='qmark', batchSize=2, fetchSize=2,
+    ...                 threads=2)
+    >>> with pool.connection() as conn:
+    ...     _ = conn.execute('CREATE TABLE users (id, name)')
+    >>> db.execute(Insert(table.users, [(1, 'bob'), (2, 'ian'), (3, 'ana')],
+    ...                   template=['id', 'name']))
+    3
+    >>> db.execute(Select([table.users.name], where=table.users.id > 1,
+    ...                   orderBy=table.users.id))
+    [(u'ian',), (u'ana',)]
+    >>> db.execute(Update(table.users, {'name': 'tim'},
+    ...                   where=table.users.id == 2))
+    1
+    >>> byId = Prepared(Select([table.users.name],
+    ...                        where=table.users.id == Param('id')),
+    ...                 paramstyle='qmark')
+    >>> db.execute(byId, id=2)
+    [(u'tim',)]
+    >>> [result.get() for result in
+    ...  [db.submit(byId, id=id) for id in (1, 3)]]
+    [[(u'bob',)], [(u'ana',)]]
+    >>> db.map([Select([table.users.id], where=table.users.id < 3,
+    ...                orderBy=table.users.id),
+    ...         Delete(table.users, where=table.users.id == 9)])
+    [[(1,), (2,)], 0]
+
+    The connection is held while a select is being read, and the
+    pool only has one:
+
+    >>> rows = db.select(Select([table.users.id]))
+    >>> rows.next()
+    (1,)
+    >>> pool.acquire()
+    Traceback (most recent call last):
+        ...
+    PoolTimeout: No connection available after 0.1 seconds
+    >>> rows.close()
+    >>> db.execute(Select([table.users.id], where=table.users.id == 9))
+    []
+    >>> db.close()
+
+    """}
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,719 @@
+"""
+Runs `sqlbuilder` ``Select`` statements against tables kept in
+memory, for hot read paths that don't need a database round trip.
+
+Rows are dictionaries, registered under a table name (or a
+``sqlbuilder.Table``).  Tables can have hash indexes (for ``=`` and
+``IN``) and sorted indexes (for ``=``, ``<``, ``<=``, ``>``, ``>=``);
+when the where clause compares an indexed field to a constant, the
+index is used to find candidate rows instead of scanning the table::
+
+    >>> from sqlbuilder import table, Select, AND, DESC
+    >>> db = MemoryDatabase()
+    >>> t = db.addTable('address', [
+    ...     {'id': 1, 'name': 'Ian', 'state': 'IL', 'zip': 60614},
+    ...     {'id': 2, 'name': 'Tim', 'state': 'MN', 'zip': 55401},
+    ...     {'id': 3, 'name': 'Bob', 'state': 'IL', 'zip': 60201},
+    ...     ], indexes=['state'], sortedIndexes=['zip'])
+    >>> a = table.address
+    >>> db.select(Select([a.name, a.zip], where=AND(a.state == 'IL', a.zip > 60000),
+    ...                  orderBy=a.zip))
+    [('Bob', 60201), ('Ian', 60614)]
+    >>> db.select(Select([a.state], groupBy=a.state, orderBy=DESC(a.state)))
+    [('MN',), ('IL',)]
+    >>> db.select(Select([a.name], orderBy=a.name, limit=2))
+    [('Bob',), ('Ian',)]
+
+When a ``Select`` uses several tables, conditions on a single table
+are applied to that table first, and equality between fields of two
+tables (like ``table.user.state == table.states.abbrev``) is run as a
+hash join.  An ``orderBy`` with a ``limit`` keeps only the top rows in
+a bounded heap instead of sorting everything::
+
+    >>> s = db.addTable('states', [{'abbrev': 'IL', 'name': 'Illinois'},
+    ...                            {'abbrev': 'MN', 'name': 'Minnesota'}])
+    >>> db.select(Select([a.name, table.states.name],
+    ...                  where=a.state == table.states.abbrev,
+    ...                  orderBy=DESC(a.zip), limit=2))
+    [('Ian', 'Illinois'), ('Bob', 'Illinois')]
+
+``groupBy`` and ``having`` are evaluated with a single pass of hash
+aggregation, keeping one set of ``COUNT``, ``SUM``, ``AVG``, ``MIN``
+and ``MAX`` accumulators per group, so memory grows with the number of
+groups rather than rows.  `selectRows` runs a ``Select`` over any
+iterable of rows, e.g., one streamed from a file::
+
+    >>> from sqlbuilder import func
+    >>> db.select(Select([a.state, func.COUNT(a.id), func.MAX(a.zip)],
+    ...                  groupBy=a.state, having=func.COUNT(a.id) > 1))
+    [('IL', 2, 60614)]
+    >>> rows = iter([{'n': 1}, {'n': 2}, {'n': 3}])
+    >>> selectRows(Select([func.SUM(table.t.n), func.AVG(table.t.n)]), rows)
+    [(6, 2.0)]
+
+Expressions are evaluated with ``sqlbuilder.compileExpression``, so
+they follow the same Python semantics as ``execute()``, including
+short-circuiting ``AND`` and ``OR``::
+
+    >>> z = db.addTable('z', [{'x': 4, 'y': 2}, {'x': 4, 'y': 0}])
+    >>> db.select(Select([table.z.x], where=AND(table.z.y != 0,
+    ...                                        table.z.x / table.z.y > 1)))
+    [(4,)]
+
+A database compiles each where clause once, and keeps it by the
+clause's ``sqlKey``.  With ``MemoryDatabase(adaptive=True)`` where
+clauses go through ``sqlbuilder.AdaptivePredicate`` instead, which
+reorders ``AND`` and ``OR`` operands by their measured cost and
+selectivity on inputs of more than ``batchSize`` rows.
+"""
+
+import bisect
+import heapq
+import itertools
+import sqlbuilder
+from sqlbuilder import NoDefault, SQLExpression, SQLOp, SQLBoolOp, SQLCall, \
+     SQLConstant, Field, DESC
+
+# (op with the field on the right) -> (op with the field on the left)
+_flippedOps = {'=': '=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+
+class MemoryTable(object):
+
+    def __init__(self, name, rows=(), indexes=(), sortedIndexes=()):
+        self.name = name
+        self.rows = []
+        self.hashIndexes = {}
+        self.sortedIndexes = {}
+        self.extend(rows)
+        for column in indexes:
+            self.addIndex(column)
+        for column in sortedIndexes:
+            self.addSortedIndex(column)
+
+    def __repr__(self):
+        return '<%s %s: %i rows>' % (
+            self.__class__.__name__, self.name, len(self.rows))
+
+    def addIndex(self, column):
+        """Adds a hash index on ``column``"""
+        index = {}
+        for position, row in enumerate(self.rows):
+            index.setdefault(row[column], []).append(position)
+        self.hashIndexes[column] = index
+
+    def addSortedIndex(self, column):
+        """Adds a sorted index on ``column``, for range lookups"""
+        pairs = sorted([(row[column], position)
+                        for position, row in enumerate(self.rows)])
+        self.sortedIndexes[column] = ([key for key, position in pairs],
+                                      [position for key, position in pairs])
+
+    def insert(self, row):
+        self.extend([row])
+
+    def extend(self, rows):
+        start = len(self.rows)
+        self.rows.extend(rows)
+        new = range(start, len(self.rows))
+        for column, index in self.hashIndexes.items():
+            for position in new:
+                index.setdefault(self.rows[position][column], []).append(position)
+        for column, (keys, positions) in self.sortedIndexes.items():
+            if len(new) > 1:
+                self.addSortedIndex(column)
+                continue
+            for position in new:
+                key = self.rows[position][column]
+                at = bisect.bisect_right(keys, key)
+                keys.insert(at, key)
+                positions.insert(at, position)
+
+    def lookup(self, column, op, value):
+        """
+        Returns the positions of rows where ``row[column] <op> value``,
+        using an index, or None if there's no suitable index.
+        """
+        if op == 'IN':
+            if column not in self.hashIndexes:
+                return None
+            index = self.hashIndexes[column]
+            result = []
+            for item in set(value):
+                result.extend(index.get(item, ()))
+            return result
+        if op == '=' and column in self.hashIndexes:
+            return list(self.hashIndexes[column].get(value, ()))
+        if column not in self.sortedIndexes:
+            return None
+        keys, positions = self.sortedIndexes[column]
+        if op == '=':
+            return positions[bisect.bisect_left(keys, value):
+                             bisect.bisect_right(keys, value)]
+        elif op == '<':
+            return positions[:bisect.bisect_left(keys, value)]
+        elif op == '<=':
+            return positions[:bisect.bisect_right(keys, value)]
+        elif op == '>':
+            return positions[bisect.bisect_right(keys, value):]
+        elif op == '>=':
+            return positions[bisect.bisect_left(keys, value):]
+        return None
+
+
+class MemoryDatabase(object):
+
+    # Compiled predicates kept, before they are all dropped
+    predicateCacheSize = 500
+
+    def __init__(self, adaptive=False, batchSize=1000):
+        self.tables = {}
+        self.adaptive = adaptive
+        self.batchSize = batchSize
+        self._predicates = {}
+
+    def addTable(self, name, rows=(), indexes=(), sortedIndexes=()):
+        name = _tableName(name)
+        memTable = MemoryTable(name, rows, indexes, sortedIndexes)
+        self.tables[name] = memTable
+        return memTable
+
+    def table(self, name):
+        return self.tables[_tableName(name)]
+
+    def filter(self, where, rows, rowType='dict'):
+        """
+        Yields the rows matching ``where``, with a predicate compiled
+        the first time the clause is seen.
+        """
+        try:
+            key = (sqlbuilder.sqlKey(where), rowType)
+        except TypeError:
+            return _filter(where, rows, rowType, self.adaptive,
+                           self.batchSize)
+        predicate = self._predicates.get(key)
+        if predicate is None:
+            if len(self._predicates) >= self.predicateCacheSize:
+                self._predicates.clear()
+            predicate = self._predicates[key] = _predicate(
+                where, rowType, self.adaptive, self.batchSize)
+        return _apply(predicate, rows)
+
+    def select(self, select):
+        """
+        Runs the ``Select`` and returns a list of tuples, one for
+        each result row.
+        """
+        tableNames = select.fromTables()
+        where = select.whereClause
+        if where is NoDefault or where is None:
+            where = None
+            conjuncts = []
+        else:
+            conjuncts = splitAND(where)
+        if len(tableNames) > 1:
+            rowType = 'tables'
+            rows = self.join(tableNames, conjuncts)
+        else:
+            rowType = 'dict'
+            if tableNames:
+                rows = self.candidates(tableNames[0], conjuncts)
+            else:
+                rows = [{}]
+            if where is not None:
+                rows = self.filter(where, rows, rowType)
+        return finishSelect(select, rows, rowType)
+
+    def candidates(self, tableName, conjuncts):
+        """
+        Returns the rows of the table that could match the conjuncts,
+        using the most selective index lookup available.
+        """
+        memTable = self.tables[tableName]
+        best = None
+        for conjunct in conjuncts:
+            comparison = fieldComparison(conjunct, tableName)
+            if comparison is None:
+                continue
+            column, op, value = comparison
+            positions = memTable.lookup(column, op, value)
+            if positions is not None and (best is None or len(positions) < len(best)):
+                best = positions
+        if best is None:
+            return memTable.rows
+        rows = memTable.rows
+        return [rows[position] for position in sorted(best)]
+
+    def join(self, tableNames, conjuncts):
+        """
+        Yields joined rows (``{tableName: row}``) matching all the
+        conjuncts.  Each table is filtered by its own conditions
+        first; tables are then added smallest first, preferring ones
+        connected by an equality to the tables already joined, which
+        are hash joined.
+        """
+        perTable = {}
+        for name in tableNames:
+            perTable[name] = []
+        links = []
+        residual = []
+        for conjunct in conjuncts:
+            used = list(sqlbuilder.tablesUsedSet(conjunct))
+            if len(used) == 1:
+                perTable[used[0]].append(conjunct)
+                continue
+            link = joinComparison(conjunct)
+            if link is not None:
+                links.append(link)
+            else:
+                residual.append(conjunct)
+        tableRows = {}
+        for name in tableNames:
+            rows = self.candidates(name, perTable[name])
+            if perTable[name]:
+                rows = list(self.filter(sqlbuilder.AND(*perTable[name]), rows))
+            tableRows[name] = rows
+        size = lambda name: len(tableRows[name])
+        start = min(tableNames, key=size)
+        joined = [start]
+        remaining = [name for name in tableNames if name != start]
+        rows = ({start: row} for row in tableRows[start])
+        while remaining:
+            connected = [name for name in remaining
+                         if _linksTo(links, joined, name)]
+            name = min(connected or remaining, key=size)
+            rows = hashJoin(rows, name, tableRows[name],
+                            _linksTo(links, joined, name))
+            joined.append(name)
+            remaining.remove(name)
+        if residual:
+            rows = self.filter(sqlbuilder.AND(*residual), rows, 'tables')
+        return rows
+
+
+def selectRows(select, rows, rowType='dict', adaptive=False):
+    """
+    Runs the ``Select`` over an iterable of rows (see
+    ``sqlbuilder.ExpressionCompiler`` for ``rowType``), ignoring the
+    tables it names.  The rows are consumed one at a time.  With
+    ``adaptive`` the where clause goes through
+    ``sqlbuilder.AdaptivePredicate``.
+    """
+    where = select.whereClause
+    if where is not NoDefault and where is not None:
+        rows = _filter(where, rows, rowType, adaptive)
+    return finishSelect(select, rows, rowType)
+
+
+def _predicate(where, rowType, adaptive, batchSize=1000):
+    if adaptive:
+        return sqlbuilder.AdaptivePredicate(where, rowType,
+                                            batchSize=batchSize)
+    return sqlbuilder.compilePredicate(where, rowType)
+
+
+def _apply(predicate, rows):
+    if isinstance(predicate, sqlbuilder.AdaptivePredicate):
+        return predicate.filter(rows)
+    return itertools.ifilter(predicate, rows)
+
+
+def _filter(where, rows, rowType, adaptive, batchSize=1000):
+    return _apply(_predicate(where, rowType, adaptive, batchSize), rows)
+
+
+def finishSelect(select, rows, rowType):
+    """
+    Groups, orders, limits and projects the rows matching a
+    ``Select``'s where clause.
+    """
+    exprs = list(select.items)
+    for clause in select.having, select.orderBy:
+        if clause is not NoDefault:
+            exprs.extend(_sequence(clause))
+    aggregates = findAggregates(exprs)
+    if (aggregates or select.groupBy is not NoDefault
+        or select.having is not NoDefault):
+        groupBy = []
+        if select.groupBy is not NoDefault:
+            groupBy = _sequence(select.groupBy)
+        rows = aggregateRows(rows, groupBy, aggregates, rowType)
+        if select.having is not NoDefault:
+            having = _compiler(rowType, aggregates)
+            rows = filter(having.function(
+                'bool(%s)' % having.source(select.having)), rows)
+    else:
+        aggregates = None
+    limit = select.limit
+    if limit is NoDefault:
+        limit = None
+    if select.orderBy is not NoDefault:
+        rows = sortRows(rows, _sequence(select.orderBy), rowType, limit,
+                        aggregates)
+    elif limit is not None:
+        rows = itertools.islice(rows, limit)
+    project = compileTuple(select.items, rowType, aggregates)
+    return [project(row) for row in rows]
+
+
+def _tableName(name):
+    if isinstance(name, sqlbuilder.Table):
+        return name.tableName
+    return name
+
+
+def _sequence(value):
+    if type(value) in (type([]), type(())):
+        return list(value)
+    return [value]
+
+
+def splitAND(expr):
+    """Returns the list of conjuncts of ``expr``"""
+    result = []
+    pending = [expr]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, SQLBoolOp) and item.op == 'AND':
+            pending.extend(reversed(item.ops))
+        elif isinstance(item, SQLOp) and item.op == 'AND':
+            pending.append(item.expr2)
+            pending.append(item.expr1)
+        else:
+            result.append(item)
+    return result
+
+
+def fieldComparison(expr, tableName):
+    """
+    If ``expr`` compares a field of the table to a constant, returns
+    ``(fieldName, op, value)`` with the field on the left; otherwise
+    None.
+    """
+    if not isinstance(expr, SQLOp):
+        return None
+    left, op, right = expr.expr1, expr.op, expr.expr2
+    if op == 'IN':
+        if (isinstance(left, Field) and left.tableName == tableName
+            and not isinstance(right, SQLExpression)):
+            return left.fieldName, op, right
+        return None
+    if op not in _flippedOps:
+        return None
+    if isinstance(right, Field) and not isinstance(left, SQLExpression):
+        left, op, right = right, _flippedOps[op], left
+    if (isinstance(left, Field) and left.tableName == tableName
+        and not isinstance(right, SQLExpression) and right is not None):
+        return left.fieldName, op, right
+    return None
+
+
+def joinComparison(expr):
+    """
+    If ``expr`` is an equality between fields of two tables, returns
+    ``((table1, field1), (table2, field2))``; otherwise None.
+    """
+    if not isinstance(expr, SQLOp) or expr.op != '=':
+        return None
+    left, right = expr.expr1, expr.expr2
+    if (isinstance(left, Field) and isinstance(right, Field)
+        and left.tableName != right.tableName):
+        return ((left.tableName, left.fieldName),
+                (right.tableName, right.fieldName))
+    return None
+
+
+def _linksTo(links, joined, name):
+    """
+    Returns ``[(joinedTable, joinedField, field)]`` for the links
+    between the joined tables and table ``name``.
+    """
+    result = []
+    for first, second in links:
+        if first[0] == name:
+            first, second = second, first
+        if second[0] == name and first[0] in joined:
+            result.append((first[0], first[1], second[1]))
+    return result
+
+
+def hashJoin(rows, tableName, tableRows, links):
+    """
+    Joins ``tableRows`` onto the joined ``rows`` where every link's
+    fields are equal; with no links it's a cross product.
+    """
+    fields = [field for joinedTable, joinedField, field in links]
+    index = {}
+    for row in tableRows:
+        key = tuple([row[field] for field in fields])
+        index.setdefault(key, []).append(row)
+    for joinedRow in rows:
+        key = tuple([joinedRow[joinedTable][joinedField]
+                     for joinedTable, joinedField, field in links])
+        for row in index.get(key, ()):
+            result = joinedRow.copy()
+            result[tableName] = row
+            yield result
+
+
+def compileTuple(exprs, rowType, aggregates=None):
+    """Compiles a function returning a tuple of the expressions' values"""
+    compiler = _compiler(rowType, aggregates)
+    sources = [compiler.source(expr) for expr in exprs]
+    return compiler.function('(%s)' % ''.join([source + ', '
+                                               for source in sources]))
+
+
+def _compiler(rowType, aggregates):
+    if aggregates is None:
+        return sqlbuilder.ExpressionCompiler(rowType)
+    return GroupCompiler(rowType, aggregates)
+
+
+########################################
+## Aggregation
+########################################
+
+class _Count(object):
+    __slots__ = ('count',)
+    def __init__(self):
+        self.count = 0
+    def add(self, value):
+        if value is not None:
+            self.count += 1
+    def value(self):
+        return self.count
+
+
+class _Sum(object):
+    __slots__ = ('total',)
+    def __init__(self):
+        self.total = None
+    def add(self, value):
+        if value is not None:
+            if self.total is None:
+                self.total = value
+            else:
+                self.total += value
+    def value(self):
+        return self.total
+
+
+class _Avg(object):
+    __slots__ = ('total', 'count')
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+    def add(self, value):
+        if value is not None:
+            self.total += value
+            self.count += 1
+    def value(self):
+        if not self.count:
+            return None
+        return float(self.total) / self.count
+
+
+class _Min(object):
+    __slots__ = ('result',)
+    def __init__(self):
+        self.result = None
+    def add(self, value):
+        if value is not None and (self.result is None or value < self.result):
+            self.result = value
+    def value(self):
+        return self.result
+
+
+class _Max(_Min):
+    __slots__ = ()
+    def add(self, value):
+        if value is not None and (self.result is None or value > self.result):
+            self.result = value
+
+
+aggregateFunctions = {
+    'COUNT': _Count,
+    'SUM': _Sum,
+    'AVG': _Avg,
+    'MIN': _Min,
+    'MAX': _Max,
+    }
+
+
+def isAggregate(expr):
+    return (isinstance(expr, SQLCall) and isinstance(expr.expr, SQLConstant)
+            and expr.expr.const.upper() in aggregateFunctions)
+
+
+def findAggregates(exprs):
+    """Returns the distinct aggregate calls used in the expressions"""
+    result = []
+    seen = {}
+    pending = list(exprs)
+    pending.reverse()
+    while pending:
+        expr = pending.pop()
+        if isAggregate(expr):
+            key = sqlbuilder.sqlKey(expr)
+            if key not in seen:
+                seen[key] = True
+                result.append(expr)
+        elif isinstance(expr, DESC):
+            pending.append(expr.expr)
+        elif isinstance(expr, SQLExpression):
+            components = list(expr.components())
+            components.reverse()
+            pending.extend(components)
+    return result
+
+
+def _aggregateArgument(call):
+    """The expression aggregated; ``COUNT(*)`` counts every row"""
+    if not call.args:
+        return 1
+    arg = call.args[0]
+    if isinstance(arg, SQLConstant) and arg.const == '*':
+        return 1
+    return arg
+
+
+class GroupCompiler(sqlbuilder.ExpressionCompiler):
+    """
+    Compiles expressions over the ``(row, aggregateValues)`` pairs
+    made by `aggregateRows`: fields come from the group's first row,
+    and aggregate calls from its values.
+    """
+
+    rowName = 'row[0]'
+
+    def __init__(self, rowType, aggregates):
+        sqlbuilder.ExpressionCompiler.__init__(self, rowType)
+        self.aggregates = {}
+        for index, call in enumerate(aggregates):
+            self.aggregates[sqlbuilder.sqlKey(call)] = index
+
+    def call(self, expr):
+        key = sqlbuilder.sqlKey(expr)
+        if key in self.aggregates:
+            return 'row[1][%i]' % self.aggregates[key]
+        return sqlbuilder.ExpressionCompiler.call(self, expr)
+
+
+class _NullRow(dict):
+    """Stands in for the missing row of an empty, ungrouped aggregate"""
+    def __missing__(self, key):
+        if self.tables:
+            return _NullRow()
+        return None
+    def __init__(self, tables=False):
+        self.tables = tables
+
+
+def aggregateRows(rows, groupBy, aggregates, rowType):
+    """
+    Hash aggregation in a single pass over ``rows``.  Returns a list
+    of ``(firstRow, aggregateValues)``, one for each distinct value of
+    the ``groupBy`` expressions, in order of first appearance.  With
+    no ``groupBy`` there is always exactly one group.
+    """
+    key = None
+    if groupBy:
+        key = compileTuple(groupBy, rowType)
+    arguments = compileTuple(
+        [_aggregateArgument(call) for call in aggregates], rowType)
+    makers = [aggregateFunctions[call.expr.const.upper()]
+              for call in aggregates]
+    groups = {}
+    order = []
+    for row in rows:
+        if key is None:
+            value = ()
+        else:
+            value = key(row)
+        group = groups.get(value)
+        if group is None:
+            group = groups[value] = (row, [make() for make in makers])
+            order.append(value)
+        for accumulator, argument in zip(group[1], arguments(row)):
+            accumulator.add(argument)
+    if not order and key is None:
+        order.append(())
+        groups[()] = (_NullRow(rowType == 'tables'),
+                      [make() for make in makers])
+    result = []
+    for value in order:
+        row, accumulators = groups.pop(value)
+        result.append((row, [accumulator.value()
+                             for accumulator in accumulators]))
+    return result
+
+
+########################################
+## Ordering
+########################################
+
+
+def orderKeys(exprs):
+    """Returns a list of ``(expr, descending)`` for an ORDER BY"""
+    result = []
+    for expr in exprs:
+        descending = False
+        while isinstance(expr, DESC):
+            expr = expr.expr
+            descending = not descending
+        result.append((expr, descending))
+    return result
+
+
+class _OrderKey(object):
+    """Sort key for an ORDER BY that mixes directions"""
+
+    __slots__ = ('values', 'descending')
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __lt__(self, other):
+        for value, otherValue, descending in zip(
+            self.values, other.values, self.descending):
+            if value != otherValue:
+                if descending:
+                    return otherValue < value
+                return value < otherValue
+        return False
+
+
+def sortRows(rows, exprs, rowType, limit=None, aggregates=None):
+    """
+    Returns the rows in order.  With a ``limit`` only that many rows
+    are kept, in a heap, so memory stays proportional to the limit.
+    """
+    keys = orderKeys(exprs)
+    key = compileTuple([expr for expr, descending in keys], rowType,
+                       aggregates)
+    directions = [descending for expr, descending in keys]
+    if len(set(directions)) == 1:
+        if limit is None:
+            return sorted(rows, key=key, reverse=directions[0])
+        elif directions[0]:
+            return heapq.nlargest(limit, rows, key=key)
+        return heapq.nsmallest(limit, rows, key=key)
+    if limit is not None:
+        return heapq.nsmallest(
+            limit, rows, key=lambda row: _OrderKey(key(row), directions))
+    rows = list(rows)
+    for expr, descending in reversed(keys):
+        compiler = _compiler(rowType, aggregates)
+        rows.sort(key=compiler.function(compiler.source(expr)),
+                  reverse=descending)
+    return rows
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
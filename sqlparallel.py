@@ -0,0 +1,261 @@
+"""
+Evaluates `sqlbuilder` filters over large data sets on a pool of
+processes.
+
+The data is split into partitions: either chunks of
+``partitionSize`` rows taken from an iterable, or shards -- picklable
+callables (e.g., ``functools.partial(readRows, path)``) that each
+return the rows of one partition, so workers can read their own data.
+Each worker compiles the where clause and the projected items once,
+and sends back only the rows that match::
+
+    pf = ParallelFilter(AND(table.log.status == 500, table.log.bytes > 1000),
+                        items=[table.log.path, table.log.bytes])
+    for path, size in pf.filter(readLog('big.log')):
+        ...
+    for row in pf.filterShards([partial(readLog, name) for name in logs]):
+        ...
+
+Results stream back in the order of the partitions, or with
+``ordered=False`` as soon as each partition is done.  At most
+``window`` partitions are in flight at a time, so an endless input
+doesn't pile up in memory.
+"""
+
+import collections
+import itertools
+import sys
+import threading
+import traceback
+from multiprocessing import Pool, cpu_count
+import sqlbuilder
+
+
+class ParallelError(Exception):
+    """An error in a worker; the message includes its traceback"""
+
+
+class ParallelFilter(object):
+
+    def __init__(self, where=None, items=None, rowType='dict', columns=None,
+                 processes=None, partitionSize=10000, ordered=True,
+                 window=None):
+        self.task = (where, items, rowType, columns)
+        self.processes = processes or cpu_count()
+        self.partitionSize = partitionSize
+        self.ordered = ordered
+        self.window = window or self.processes * 2
+
+    def filter(self, rows):
+        """
+        Yields the matching rows (or tuples of ``items``), sending
+        the rows to the workers in partitions.
+        """
+        return self._run(_filterRows, partitions(rows, self.partitionSize))
+
+    def filterShards(self, shards):
+        """
+        Yields the matching rows (or tuples of ``items``) from all
+        the shards, each read and filtered by a worker.
+        """
+        return self._run(_filterShard, shards)
+
+    def _run(self, func, parts):
+        pool = Pool(self.processes)
+        if self.ordered:
+            results = self._ordered(pool, func, parts)
+        else:
+            results = self._unordered(pool, func, parts)
+        try:
+            for rows in results:
+                for row in rows:
+                    yield row
+        finally:
+            # The pool only has the (at most window) partitions it was
+            # given left to finish.  It isn't terminated: that can
+            # leave its task thread stuck writing one to a worker.
+            results.close()
+            pool.close()
+            pool.join()
+
+    def _ordered(self, pool, func, parts):
+        pending = collections.deque()
+        for part in parts:
+            pending.append(pool.apply_async(func, (self.task, part)))
+            if len(pending) >= self.window:
+                yield _result(pending.popleft().get())
+        while pending:
+            yield _result(pending.popleft().get())
+
+    def _unordered(self, pool, func, parts):
+        # imap_unordered raises errors the pool itself runs into (e.g.,
+        # a result row that can't be pickled), which apply_async's
+        # callback never hears about
+        feed = _Feed(func, self.task, parts, self.window)
+        try:
+            for result in pool.imap_unordered(_call, feed):
+                feed.window.release()
+                yield _result(result)
+        finally:
+            feed.stop()
+        feed.check()
+
+
+def partitions(rows, size):
+    """Yields lists of up to ``size`` rows"""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+class _Feed(object):
+    """
+    The tasks for ``imap_unordered``, which reads them in the pool's
+    task thread.  Only ``window`` more are handed out than there are
+    results taken (each taken result releases ``window``).  An error
+    reading the parts is kept for `check` to raise in the caller, as
+    in the task thread it would leave the pool waiting.
+    """
+
+    def __init__(self, func, task, parts, window):
+        self.func = func
+        self.task = task
+        self.parts = parts
+        self.window = threading.Semaphore(window)
+        self.stopped = False
+        self.error = None
+
+    def __iter__(self):
+        try:
+            for part in self.parts:
+                self.window.acquire()
+                if self.stopped:
+                    return
+                yield self.func, self.task, part
+        except Exception:
+            self.error = sys.exc_info()
+
+    def stop(self):
+        self.stopped = True
+        self.window.release()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+
+def _result(result):
+    ok, value = result
+    if not ok:
+        raise ParallelError(value)
+    return value
+
+
+########################################
+## Worker side
+########################################
+
+# Compiled (predicate, projection) for each task, kept per process
+_compiled = {}
+
+
+def _compile(task):
+    where, items, rowType, columns = task
+    key = (sqlbuilder.sqlKey(where), sqlbuilder.sqlKey(items), rowType,
+           sqlbuilder.sqlKey(columns))
+    if key not in _compiled:
+        predicate = project = None
+        if where is not None:
+            predicate = sqlbuilder.compilePredicate(where, rowType, columns)
+        if items is not None:
+            compiler = sqlbuilder.ExpressionCompiler(rowType, columns)
+            project = compiler.function('(%s)' % ''.join(
+                [compiler.source(item) + ', ' for item in items]))
+        _compiled[key] = predicate, project
+    return _compiled[key]
+
+
+def _apply(task, rows):
+    predicate, project = _compile(task)
+    if predicate is not None:
+        rows = itertools.ifilter(predicate, rows)
+    if project is not None:
+        return [project(row) for row in rows]
+    return list(rows)
+
+
+def _call(args):
+    func, task, part = args
+    return func(task, part)
+
+
+def _filterRows(task, rows):
+    try:
+        return True, _apply(task, rows)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _filterShard(task, shard):
+    try:
+        return True, _apply(task, shard())
+    except Exception:
+        return False, traceback.format_exc()
+
+__test__ = {
+    'sqlparallel':
+    r"""
+    >>> from functools import partial
+    >>> t = sqlbuilder.table.t
+    >>> rows = [{'x': x} for x in range(20)]
+    >>> pf = ParallelFilter(t.x > 12, items=[t.x * 2], processes=2,
+    ...                     partitionSize=4, window=2)
+    >>> list(pf.filter(rows))
+    [(26,), (28,), (30,), (32,), (34,), (36,), (38,)]
+    >>> pf = ParallelFilter(t.x > 15, processes=2, ordered=False)
+    >>> sorted(row['x'] for row in pf.filterShards(
+    ...     [partial(list, rows[:10]), partial(list, rows[10:])]))
+    [16, 17, 18, 19]
+    >>> pf = ParallelFilter(t.x / t.y > 1, processes=2)
+    >>> list(pf.filter([{'x': 1, 'y': 0}])) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+        ...
+    ParallelError: ...ZeroDivisionError...
+
+    A result that can't be sent back raises too, in either order:
+
+    >>> for ordered in True, False:
+    ...     pf = ParallelFilter(processes=2, ordered=ordered)
+    ...     try:
+    ...         list(pf.filterShards([partial(map, iter, [[1]])]))
+    ...     except Exception, e:
+    ...         print type(e).__name__
+    MaybeEncodingError
+    MaybeEncodingError
+
+    Stopping early, even with an endless input, or an error reading
+    the input, doesn't leave the pool waiting:
+
+    >>> endless = ({'x': x} for x in itertools.count())
+    >>> for ordered in True, False:
+    ...     pf = ParallelFilter(t.x > 2, processes=2, ordered=ordered,
+    ...                         window=2)
+    ...     print len(list(itertools.islice(pf.filter(endless), 20000)))
+    20000
+    20000
+    >>> def badRows():
+    ...     yield {'x': 3}
+    ...     raise KeyError('broken input')
+    >>> list(pf.filter(badRows()))
+    Traceback (most recent call last):
+        ...
+    KeyError: 'broken input'
+
+    """}
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
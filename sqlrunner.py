@@ -0,0 +1,287 @@
+"""
+Runs `sqltemplate` templates on a bounded pool of worker threads, so
+callers that mustn't block on the DB-API driver (an event loop, say)
+can wait on futures instead.
+
+The futures are ``concurrent.futures`` futures (the ``futures``
+package on Python 2): a Tornado coroutine can yield them, and
+``asyncio.wrap_future`` can await them::
+
+    import sqlite3
+    from sqldbapi import ConnectionPool
+    pool = ConnectionPool(
+        lambda: sqlite3.connect('app.db', check_same_thread=False), size=4)
+    runner = TemplateRunner(pool, paramstyle=sqlite3.paramstyle, workers=4)
+
+    rows = yield runner.run('SELECT * FROM user WHERE id = {{id}}', id=10)
+
+    stream = runner.fetch('SELECT * FROM log', batch_size=500)
+    while True:
+        rows = yield stream.next_batch()
+        if not rows:
+            break
+        ...
+
+Templates can be `SQLTemplate` objects, or source strings (parsed
+through ``SQLTemplate.cached``).  Rendering and execution both happen
+on the workers.  At most ``workers`` statements run at once, each on a
+connection from the `sqldbapi.ConnectionPool`; connections are used
+from more than one thread, so SQLite needs ``check_same_thread=False``.
+
+`TemplateRunner.cancel` cancels a statement that hasn't started, and
+interrupts one that is running if the connection has an
+``interrupt()`` method (as ``sqlite3`` connections do).
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqltemplate import SQLTemplate
+
+
+class _Job(object):
+    """The connection a statement is running on, if any"""
+
+    def __init__(self):
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def interrupt(self):
+        with self.lock:
+            if self.conn is None or not hasattr(self.conn, 'interrupt'):
+                return False
+            self.conn.interrupt()
+            return True
+
+
+class TemplateRunner(object):
+
+    def __init__(self, pool, paramstyle='format', workers=4):
+        self.pool = pool
+        self.paramstyle = paramstyle
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def render(self, template, **ns):
+        """Return (sql, params) for the template"""
+        if isinstance(template, basestring):
+            template = SQLTemplate.cached(template)
+        return template.substitute(ns).args(self.paramstyle)
+
+    def run(self, template, **ns):
+        """Return a future of the statement's result
+
+        A statement that returns rows gives a list of them; anything
+        else is committed, and gives the rowcount.
+        """
+        return self._submit(self._run, template, ns)
+
+    def fetch(self, template, batch_size=500, **ns):
+        """Return a `RowStream` over the rows of the statement"""
+        return RowStream(self, template, ns, batch_size)
+
+    def cancel(self, future):
+        """Cancel or interrupt the statement; return True if it was"""
+        if future.cancel():
+            return True
+        with self._lock:
+            job = self._jobs.get(future)
+        if job is None:
+            return False
+        return job.interrupt()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+
+    def _submit(self, func, *args):
+        job = _Job()
+        future = self.executor.submit(func, job, *args)
+        with self._lock:
+            self._jobs[future] = job
+        future.add_done_callback(self._forget)
+        return future
+
+    def _forget(self, future):
+        with self._lock:
+            self._jobs.pop(future, None)
+
+    def _run(self, job, template, ns):
+        sql, params = self.render(template, **ns)
+        with self.pool.connection() as conn:
+            with job.lock:
+                job.conn = conn
+            try:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(sql, params)
+                    if cursor.description is not None:
+                        return cursor.fetchall()
+                    conn.commit()
+                    return cursor.rowcount
+                finally:
+                    cursor.close()
+            finally:
+                with job.lock:
+                    job.conn = None
+
+
+class RowStream(object):
+    """
+    The rows of one statement, fetched ``batch_size`` at a time on the
+    runner's workers.  Call `next_batch` for a future of the next list
+    of rows; an empty list means the rows are exhausted.  The
+    connection is held until then, or until `close` (a stream can be
+    used in a ``with`` block, and closes itself when it is garbage
+    collected).
+    """
+
+    def __init__(self, runner, template, ns, batch_size):
+        self.runner = runner
+        self.template = template
+        self.ns = ns
+        self.batch_size = batch_size
+        self.conn = self.cursor = None
+        self.done = False
+        self._lock = threading.Lock()
+
+    def next_batch(self):
+        return self.runner._submit(self._fetch)
+
+    def close(self):
+        """Release the connection
+
+        This happens in the calling thread, not on a worker: the
+        workers may all be waiting for this very connection.  If a
+        batch is being fetched, it waits for that to finish.
+        """
+        with self._lock:
+            self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        if not self.done:
+            self._release()
+
+    def _fetch(self, job):
+        with self._lock:
+            if self.done:
+                return []
+            try:
+                if self.cursor is None:
+                    sql, params = self.runner.render(self.template, **self.ns)
+                    self.conn = self.runner.pool.acquire()
+                    self.cursor = self.conn.cursor()
+                    with job.lock:
+                        job.conn = self.conn
+                    self.cursor.execute(sql, params)
+                else:
+                    with job.lock:
+                        job.conn = self.conn
+                rows = self.cursor.fetchmany(self.batch_size)
+            except:
+                self._release()
+                raise
+            finally:
+                with job.lock:
+                    job.conn = None
+            if not rows:
+                self._release()
+            return rows
+
+    def _release(self):
+        self.done = True
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            discard = False
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+            self.runner.pool.release(conn, discard=discard)
+
+__test__ = {
+    'sqlrunner':
+    r"""
+    >>> import sqlite3
+    >>> from sqldbapi import ConnectionPool
+    >>> pool = ConnectionPool(
+    ...     lambda: sqlite3.connect(':memory:', check_same_thread=False), size=1)
+    >>> runner = TemplateRunner(pool, paramstyle='qmark', workers=2)
+    >>> runner.render('SELECT * FROM user WHERE id = {{id}}', id=10)
+    (u'SELECT * FROM user WHERE id = ?', [10])
+    >>> runner.run('CREATE TABLE user (id, name)').result()
+    -1
+    >>> for id, name in [(1, 'bob'), (2, 'ian'), (3, 'ana')]:
+    ...     runner.run('INSERT INTO user VALUES ({{id}}, {{name}})',
+    ...                id=id, name=name).result()
+    1
+    1
+    1
+    >>> runner.run('SELECT name FROM user WHERE id > {{id}} ORDER BY id',
+    ...            id=1).result()
+    [(u'ian',), (u'ana',)]
+    >>> stream = runner.fetch('SELECT id FROM user ORDER BY id', batch_size=2)
+    >>> stream.next_batch().result()
+    [(1,), (2,)]
+    >>> stream.next_batch().result()
+    [(3,)]
+    >>> stream.next_batch().result()
+    []
+    >>> stream.next_batch().result()
+    []
+
+    Errors come back through the future, and the connection is
+    returned to the pool:
+
+    >>> runner.run('SELECT * FROM nope').result()
+    Traceback (most recent call last):
+        ...
+    OperationalError: no such table: nope
+    >>> stream = runner.fetch('SELECT id FROM user', batch_size=1)
+    >>> stream.next_batch().result()
+    [(1,)]
+    >>> stream.close()
+    >>> runner.run('SELECT count(*) FROM user').result()
+    [(3,)]
+
+    Closing doesn't need a worker, so it works while they are all
+    waiting for the stream's connection:
+
+    >>> stream = runner.fetch('SELECT id FROM user', batch_size=1)
+    >>> stream.next_batch().result()
+    [(1,)]
+    >>> counts = [runner.run('SELECT count(*) FROM user') for i in range(2)]
+    >>> stream.close()
+    >>> [future.result() for future in counts]
+    [[(3,)], [(3,)]]
+    >>> with runner.fetch('SELECT id FROM user', batch_size=1) as stream:
+    ...     stream.next_batch().result()
+    [(1,)]
+    >>> stream = runner.fetch('SELECT id FROM user', batch_size=1)
+    >>> stream.next_batch().result()
+    [(1,)]
+    >>> del stream
+    >>> runner.run('SELECT count(*) FROM user').result()
+    [(3,)]
+    >>> future = runner.run('SELECT 1')
+    >>> future.result()
+    [(1,)]
+    >>> runner.cancel(future)
+    False
+    >>> runner.close()
+
+    """}
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
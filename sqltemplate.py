@@ -1,6 +1,8 @@
 import re
 import sys
+import threading
 import tempita
+from collections import OrderedDict
 
 _var_re = re.compile(r'\{\{(.*?)\}\}')
 
@@ -13,22 +15,41 @@ def sqlsub(tmpl, stacklevel=1, marker='%s', f_globals=None, **args):
 
     """
     if not args:
-        args = {}
         frame = sys._getframe(stacklevel)
         args = frame.f_locals
         f_globals = frame.f_globals
+        del frame
     if f_globals is None:
         f_globals = {}
-    params = []
-    sql = []
+    sql, codes = _sqlsub_plan(tmpl, marker)
+    return sql, [eval(code, f_globals, args) for code in codes]
+
+
+# (tmpl, marker) -> (sql, code objects), cleared when it gets too big
+_sqlsub_plans = {}
+_sqlsub_plans_size = 500
+
+
+def _sqlsub_plan(tmpl, marker):
+    key = (tmpl, marker)
+    try:
+        return _sqlsub_plans[key]
+    except KeyError:
+        pass
+    fragments = []
+    codes = []
     last_end = 0
     for match in _var_re.finditer(tmpl):
-        sql.append(tmpl[last_end:match.start()])
-        sql.append(marker)
-        params.append(eval(match.group(1), args, f_globals))
+        fragments.append(tmpl[last_end:match.start()])
+        codes.append(compile(match.group(1).strip(), '<sqlsub %r>' % tmpl,
+                             'eval'))
         last_end = match.end()
-    sql.append(tmpl[last_end:])
-    return ''.join(sql), params
+    fragments.append(tmpl[last_end:])
+    plan = marker.join(fragments), tuple(codes)
+    if len(_sqlsub_plans) >= _sqlsub_plans_size:
+        _sqlsub_plans.clear()
+    _sqlsub_plans[key] = plan
+    return plan
 
 
 class sql(unicode):
@@ -70,6 +91,59 @@ def updates(values):
     return l
 
 
+def _bucket(n):
+    """The smallest power of two that is >= n"""
+    return 1 << max(n - 1, 0).bit_length()
+
+
+def _placeholders(values, length, row=False):
+    values = list(values)
+    values.extend([values[-1]] * (length - len(values)))
+    l = sqllist()
+    l.append(sql('(VALUES (' if row else '('))
+    sep = sql('), (' if row else ', ')
+    for index, value in enumerate(values):
+        if index:
+            l.append(sep)
+        l.append(value)
+    l.append(sql('))' if row else ')'))
+    return l
+
+
+def inlist(values, max_bucket=1024):
+    """Expand values for ``IN {{inlist(values)}}``
+
+    The list is padded with its last value to a power of two, so
+    lists of any length up to max_bucket give only a dozen or so
+    statement shapes.  Longer lists become a ``VALUES`` subquery
+    (selecting ``column1``, as SQLite and PostgreSQL name it), padded
+    to a multiple of max_bucket.  An empty list gives an empty
+    subquery, so ``IN`` matches no rows and ``NOT IN`` matches them
+    all.  See also `inlist_chunks`.
+    """
+    values = list(values)
+    if not values:
+        return sqllist([sql('(SELECT NULL WHERE 1 = 0)')])
+    if len(values) <= max_bucket:
+        return _placeholders(values, _bucket(len(values)))
+    length = -(-len(values) // max_bucket) * max_bucket
+    l = sqllist([sql('(SELECT column1 FROM ')])
+    l.append(_placeholders(values, length, row=True))
+    l.append(sql(' AS inlist)'))
+    return l
+
+
+def inlist_chunks(values, size=1024):
+    """Yield `inlist` expansions of up to size values each
+
+    Use this to run one statement per chunk instead of one statement
+    with a very long list.
+    """
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield inlist(values[start:start + size], size)
+
+
 class SQLTemplate(tempita.Template):
 
     default_namespace = tempita.Template.default_namespace.copy()
@@ -77,6 +151,7 @@ class SQLTemplate(tempita.Template):
         sql=sql,
         inserts=inserts,
         updates=updates,
+        inlist=inlist,
         ))
 
     def _repr(self, value, pos):
@@ -87,10 +162,37 @@ class SQLTemplate(tempita.Template):
         else:
             return _SQLValue(value)
 
+    @classmethod
+    def cached(cls, content, name=None):
+        """Return a parsed template for content, from template_cache
+
+        Use this instead of ``SQLTemplate(content)`` when the same
+        source is substituted over and over.
+        """
+        return template_cache.get(cls, content, name)
+
     def substitute(self, *args, **kw):
         result = super(SQLTemplate, self).substitute(*args, **kw)
         return SQLExpression.from_sequence(result)
 
+    def substitute_many(self, namespaces, paramstyle='format'):
+        """Substitute each namespace, returning [(sql, params_list)]
+
+        Rows that render to the same SQL are put in one batch, ready
+        for ``cursor.executemany(sql, params_list)``; batches are in
+        the order their first row appeared.
+        """
+        batches = OrderedDict()
+        for ns in namespaces:
+            sql, params = self.substitute(ns).args(paramstyle)
+            if isinstance(params, list):
+                params = tuple(params)
+            batch = batches.get(sql)
+            if batch is None:
+                batch = batches[sql] = []
+            batch.append(params)
+        return batches.items()
+
     def _interpret(self, ns):
         __traceback_hide__ = True
         parts = []
@@ -103,56 +205,125 @@ class SQLTemplate(tempita.Template):
         return parts, defs, inherit
 
 
+class TemplateCache(object):
+    """A bounded LRU cache of parsed templates
+
+    Templates are keyed on their class, source and name; ``hits`` and
+    ``misses`` count lookups, so you can tell if ``size`` is big
+    enough.
+    """
+
+    def __init__(self, size=500):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cls, content, name=None):
+        key = (cls, content, name)
+        with self._lock:
+            tmpl = self._cache.pop(key, None)
+            if tmpl is not None:
+                self.hits += 1
+                self._cache[key] = tmpl
+                return tmpl
+            self.misses += 1
+        # Parse outside the lock; if two threads race, both templates
+        # work the same and the last one is kept
+        tmpl = cls(content, name=name)
+        with self._lock:
+            self._cache[key] = tmpl
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return tmpl
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._cache), 'size': self.size}
+
+
+template_cache = TemplateCache()
+
+
 class SQLExpression(object):
 
     def __init__(self, sql_chunks, params):
         self.sql_chunks = sql_chunks
         self.params = params
+        self._args = {}
 
     def args(self, paramstyle='format'):
-        sql = [self.sql_chunks[0]]
-        if paramstyle in ['qmark', 'format', 'numeric']:
-            params = []
+        """Return (sql, params) for the DB-API paramstyle
+
+        The result is kept for each paramstyle; each call gets its own
+        copy of params, so it can be changed.
+        """
+        try:
+            sql, params = self._args[paramstyle]
+        except KeyError:
+            sql, params = self._args[paramstyle] = self._make_args(paramstyle)
+        if isinstance(params, dict):
+            return sql, dict(params)
+        return sql, list(params)
+
+    def _make_args(self, paramstyle):
+        if paramstyle == 'qmark':
+            markers = ['?'] * len(self.params)
+        elif paramstyle == 'format':
+            markers = ['%s'] * len(self.params)
+        elif paramstyle == 'numeric':
+            markers = [':%s' % (index + 1)
+                       for index in range(len(self.params))]
+        elif paramstyle == 'named':
+            markers = [':n%s' % index for index in range(len(self.params))]
+        elif paramstyle == 'pyformat':
+            markers = ['%%(n%s)s' % index for index in range(len(self.params))]
         else:
-            params = {}
-        for index, (chunk, param) in enumerate(zip(self.sql_chunks[1:], self.params)):
-            if paramstyle in ('qmark', 'format'):
-                if paramstyle == 'qmark':
-                    sql.append('?')
-                elif paramstyle == 'format':
-                    sql.append('%s')
-                else:
-                    sql.append(':%s' % index)
-                params.append(param)
-            else:
-                if paramstyle == 'named':
-                    sql.append(':n%s' % index)
-                elif paramstyle == 'pyformat':
-                    sql.append('%%(n%s)' % index)
-                params['n%s' % index] = param
+            raise ValueError('Unknown paramstyle: %r' % paramstyle)
+        if paramstyle in ('named', 'pyformat'):
+            params = dict(('n%s' % index, param)
+                          for index, param in enumerate(self.params))
+        else:
+            params = list(self.params)
+        sql = [self.sql_chunks[0]]
+        for marker, chunk in zip(markers, self.sql_chunks[1:]):
+            sql.append(marker)
             sql.append(chunk)
-        return (''.join(sql), params)
+        return ''.join(sql), params
 
     @classmethod
     def from_sequence(cls, seq):
-        chunks = ['']
+        chunks = []
         params = []
+        current = []
         for item in cls._flatten(seq):
             if isinstance(item, _SQLValue):
                 params.append(item.value)
-                chunks.append('')
+                chunks.append(u''.join(current))
+                current = []
             else:
-                chunks[-1] += unicode(item)
+                current.append(unicode(item))
+        chunks.append(u''.join(current))
         return cls(chunks, params)
 
     @staticmethod
     def _flatten(seq):
         result = []
-        for item in seq:
-            if hasattr(item, '__sqllist__'):
-                result.extend(SQLExpression._flatten(item))
-            else:
+        stack = [iter(seq)]
+        while stack:
+            for item in stack[-1]:
+                if hasattr(item, '__sqllist__'):
+                    stack.append(iter(item))
+                    break
                 result.append(item)
+            else:
+                stack.pop()
         return result
 
     def __repr__(self):
@@ -180,6 +351,44 @@ __test__ = {
     <sql INSERT INTO test (a, b) VALUES ({1}, {2})>
     >>> SQLTemplate('UPDATE test SET {{updates(dict(a=1, b=2))}}').substitute()
     <sql UPDATE test SET a={1}, b={2}>
+    >>> template_cache.clear()
+    >>> for id in 1, 2:
+    ...     SQLTemplate.cached('SELECT * FROM user WHERE id = {{id}}').substitute(id=id)
+    <sql SELECT * FROM user WHERE id = {1}>
+    <sql SELECT * FROM user WHERE id = {2}>
+    >>> sorted(template_cache.stats().items())
+    [('entries', 1), ('hits', 1), ('misses', 1), ('size', 500)]
+    >>> expr = SQLTemplate('SELECT * FROM user WHERE id = {{1}} OR id = {{2}}').substitute()
+    >>> expr.args('numeric')
+    (u'SELECT * FROM user WHERE id = :1 OR id = :2', [1, 2])
+    >>> expr.args('pyformat')
+    (u'SELECT * FROM user WHERE id = %(n0)s OR id = %(n1)s', {'n0': 1, 'n1': 2})
+    >>> sql, params = expr.args('numeric')
+    >>> params.append(3)
+    >>> expr.args('numeric')
+    (u'SELECT * FROM user WHERE id = :1 OR id = :2', [1, 2])
+    >>> tmpl = SQLTemplate('INSERT INTO test (a, b) VALUES ({{a}}, {{b or sql("DEFAULT")}})')
+    >>> for sql, params in tmpl.substitute_many(
+    ...         [dict(a=1, b=2), dict(a=3, b=None), dict(a=5, b=6)], 'qmark'):
+    ...     print sql, params
+    INSERT INTO test (a, b) VALUES (?, ?) [(1, 2), (5, 6)]
+    INSERT INTO test (a, b) VALUES (?, DEFAULT) [(3,)]
+    >>> tmpl = SQLTemplate('SELECT * FROM user WHERE id IN {{inlist(ids)}}')
+    >>> tmpl.substitute(ids=[1, 2, 3])
+    <sql SELECT * FROM user WHERE id IN ({1}, {2}, {3}, {3})>
+    >>> tmpl.substitute(ids=[])
+    <sql SELECT * FROM user WHERE id IN (SELECT NULL WHERE 1 = 0)>
+    >>> import sqlite3
+    >>> db = sqlite3.connect(':memory:')
+    >>> _ = db.executescript('CREATE TABLE user (id); INSERT INTO user VALUES (1);')
+    >>> for op in 'IN', 'NOT IN':
+    ...     tmpl = SQLTemplate('SELECT id FROM user WHERE id %s {{inlist(ids)}}' % op)
+    ...     print op, db.execute(*tmpl.substitute(ids=[]).args('qmark')).fetchall()
+    IN []
+    NOT IN [(1,)]
+    >>> tmpl = SQLTemplate('SELECT * FROM user WHERE id IN {{inlist(ids, 16)}}')
+    >>> len(set(tmpl.substitute(ids=range(n)).args()[0] for n in range(1, 100)))
+    11
 
     """}
 